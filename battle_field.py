@@ -1,4 +1,3 @@
-from gevent import monkey; monkey.patch_all()
 import os
 import sys
 import time
@@ -7,23 +6,71 @@ import functools
 import random
 import json
 import queue
+import argparse
+import multiprocessing
+import struct
+import zlib
+import mmap
+import collections
+import asyncio
+import urllib.parse
+from array import array
 
-import redis
 import gevent
-import gevent.queue
-
-if os.environ.get("REDISCLOUD_URL"):
-    REDIS_URL = os.environ.get("REDISCLOUD_URL")
-else:
-    REDIS_URL = None
-    print("No redis url!")
-    sys.exit(1)
-    
-pool = redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=30)
-redisConn = redis.Redis(connection_pool = pool)
+import gevent.event
+from gevent import monkey
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+REDIS_URL = os.environ.get("REDISCLOUD_URL")
+# redis-py is only loaded by the first getRedis, so importing the module
+# stays cheap and games can run with no redis at all. Importing does not
+# monkey patch either. The gevent entry points, the __main__ block and
+# runWorker, call monkey.patch_all() before anything else, and so must any
+# other program that uses redis from greenlets
+redis = None
+redisConn = None
+
+def getRedis():
+    global redis, redisConn
+    if redisConn == None:
+        if not REDIS_URL:
+            raise RuntimeError("No redis url!")
+        import redis
+        pool = redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=30)
+        redisConn = redis.Redis(connection_pool = pool)
+    return redisConn
+
+# Transport of games made without one, gevent, asyncio or memory
+TRANSPORT = os.environ.get("TRANSPORT", "gevent" if REDIS_URL else "memory")
+# Use the NumPy bullet engine instead of per-object Bullet.move
+VECTOR_BULLETS = os.environ.get("VECTOR_BULLETS") == "1"
+# Publish dynamicGameDelta messages instead of a full snapshot every broadcast
+DELTA_BROADCAST = os.environ.get("DELTA_BROADCAST") == "1"
+# Also publish to every player only the entities within this many pixels
+VIEW_RADIUS = float(os.environ["VIEW_RADIUS"]) if os.environ.get("VIEW_RADIUS") else None
+# Simulation rate. Below 60, turn on SWEPT_COLLISION so fast bullets do not
+# pass through walls and players between two frames
+FRAME_PER_SEC = int(os.environ.get("FRAME_PER_SEC", 60))
+SWEPT_COLLISION = os.environ.get("SWEPT_COLLISION") == "1"
+# Rooms hosted by a RoomManager record an ActionLog replay in this directory
+REPLAY_DIR = os.environ.get("REPLAY_DIR")
+# Map file or Tiled JSON map games are played on
+MAP_PATH = os.environ.get("MAP_PATH", "./map.json")
+# Rooms with humans in them are filled up with bots to this many players
+BOTS = int(os.environ.get("BOTS", 0))
 
 GRID_SIZE = 64
 
+BULLET_FEATURES = ["bounce", "penetrate", "zigzag", "variantSpeed", "doubleLength"]
+BULLET_FEATURE_BITS = {feature: 1 << i for i, feature in enumerate(BULLET_FEATURES)}
+
 # decorator
 def actionRequire(*required_args):
     def decorator(func):
@@ -42,11 +89,16 @@ def actionRequire(*required_args):
     return decorator
 
 class Point:
+    __slots__ = ('x', 'y')
+
     def __init__(self, x = 0, y = 0):
         self.x = x
         self.y = y
     def copy(self):
         return Point(self.x, self.y)
+    def set(self, x, y):
+        self.x = x
+        self.y = y
     def getDist(self, p):
         return ((p.x - self.x)**2 + (p.y-self.y)**2)**0.5
     def getAngle(self, p):
@@ -67,60 +119,556 @@ class Point:
     def __repr__(self):
         return "({}, {})".format(self.x, self.y)
 
-class MapCell:
-    def __init__(self, tile = 1):
-        self.walkable = True
-        self.tile = tile
-    def getInfo(self):
-        return {'tile':self.tile}
+# Distance from (px, py) to the segment from (x0, y0) to (x1, y1)
+def segmentDist(px, py, x0, y0, x1, y1):
+    dx = x1 - x0
+    dy = y1 - y0
+    l2 = dx*dx + dy*dy
+    t = 0
+    if l2 > 0:
+        t = min(1, max(0, ((px - x0)*dx + (py - y0)*dy) / l2))
+    return math.hypot(px - x0 - t*dx, py - y0 - t*dy)
 
+# A map is one binary image: a header, the blocked flag of every tile row
+# by row, the summed-area table over the flags, so the number of blocked
+# cells in any rectangle is four lookups, and the tile ids in square chunks
+# of chunkSize tiles. Sections start at page boundaries and numbers are
+# little endian. Map files in this format are memory mapped, so a map of
+# any size loads at once, pages are only read when they are used, and all
+# the rooms on a host share them. Tiled JSON maps are packed into the same
+# image in memory, or converted to a file once with --convert-map
 class Map:
-    def __init__(self, height = 30, width = 30):
-        self.height = height
+    magic = b'BFMP'
+    version = 1
+    # magic, version, width, height, tile size in pixels, chunk size in tiles
+    header = struct.Struct('<4sBIIHH')
+    pageSize = 4096
+    # Tiled keeps the flip and rotation flags in the top bits of a gid
+    tileIdMask = 0x1FFFFFFF
+
+    def __init__(self, height = 30, width = 30, fileName = None):
+        # getInfo is built once per map load
+        self.info = None
+        if fileName != None:
+            self.load(fileName)
+        else:
+            self.loadImage(Map.packImage(width, height, bytearray(width * height), array('H', bytes(2 * width * height))))
+
+    # Offsets of the blocked flags, the summed-area table and the tile
+    # chunks, and the size of the image
+    @classmethod
+    def getLayout(cls, width, height, chunkSize):
+        align = lambda n: (n + cls.pageSize - 1) // cls.pageSize * cls.pageSize
+        blockedOffset = align(cls.header.size)
+        sumOffset = align(blockedOffset + width * height)
+        tileOffset = align(sumOffset + 4 * (width + 1) * (height + 1))
+        chunks = -(-width // chunkSize) * -(-height // chunkSize)
+        return blockedOffset, sumOffset, tileOffset, tileOffset + chunks * 2 * chunkSize * chunkSize
+
+    @staticmethod
+    def buildBlockedSum(blocked, width, height):
+        blockedSum = array('I', bytes(4 * (width + 1) * (height + 1)))
+        for j in range(height):
+            rowSum = 0
+            for i in range(width):
+                rowSum += blocked[j*width + i]
+                blockedSum[(j+1)*(width+1) + i+1] = blockedSum[j*(width+1) + i+1] + rowSum
+        return blockedSum
+
+    # Image of a map from its blocked flags and tile ids, both row by row
+    @classmethod
+    def packImage(cls, width, height, blocked, tiles, tileSize = GRID_SIZE, chunkSize = 32):
+        blockedOffset, sumOffset, tileOffset, size = cls.getLayout(width, height, chunkSize)
+        image = bytearray(size)
+        cls.header.pack_into(image, 0, cls.magic, cls.version, width, height, tileSize, chunkSize)
+        image[blockedOffset:blockedOffset + width * height] = blocked
+        blockedSum = cls.buildBlockedSum(blocked, width, height)
+        tiles = array('H', tiles)
+        if sys.byteorder != 'little':
+            blockedSum.byteswap()
+            tiles.byteswap()
+        image[sumOffset:sumOffset + 4 * len(blockedSum)] = blockedSum.tobytes()
+        offset = tileOffset
+        for j0 in range(0, height, chunkSize):
+            for i0 in range(0, width, chunkSize):
+                for j in range(j0, min(j0 + chunkSize, height)):
+                    row = tiles[j*width + i0:j*width + min(i0 + chunkSize, width)].tobytes()
+                    rowOffset = offset + 2 * (j - j0) * chunkSize
+                    image[rowOffset:rowOffset + len(row)] = row
+                offset += 2 * chunkSize * chunkSize
+        return image
+
+    # image is anything with the buffer protocol, a bytearray or an mmap
+    def loadImage(self, image):
+        if len(image) < self.header.size:
+            raise ValueError("Not a map image")
+        magic, version, width, height, tileSize, chunkSize = self.header.unpack_from(image, 0)
+        if magic != self.magic or version != self.version:
+            raise ValueError("Not a map image")
+        blockedOffset, sumOffset, tileOffset, size = self.getLayout(width, height, chunkSize)
+        if len(image) < size:
+            raise ValueError("Truncated map image")
+        self.image = image
         self.width = width
-        self.data = [[MapCell(tile = i) for i in range(self.width)] for j in range(self.height)]
-        self.gridSize = GRID_SIZE
+        self.height = height
+        self.gridSize = tileSize
+        self.chunkSize = chunkSize
+        self.chunkColumns = -(-width // chunkSize)
+        self.tileOffset = tileOffset
+        self.chunks = {}
+        view = memoryview(image)
+        self.blocked = view[blockedOffset:blockedOffset + width * height]
+        self.blockedSum = view[sumOffset:sumOffset + 4 * (width + 1) * (height + 1)].cast('I')
+        if sys.byteorder != 'little':
+            self.blockedSum = array('I', self.blockedSum.tobytes())
+            self.blockedSum.byteswap()
+        self.info = None
+        self.navField = None
+        self.blockedGrid = None
+        self.blockedSumGrid = None
+        self.crc = None
+
+    # Map file or Tiled JSON map, told apart by the magic
+    def load(self, fileName):
+        with open(fileName, 'rb') as f:
+            magic = f.read(len(self.magic))
+        if magic == self.magic:
+            self.loadFile(fileName)
+        else:
+            self.loadJson(fileName)
+
+    def loadFile(self, fileName):
+        with open(fileName, 'rb') as f:
+            self.loadImage(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
+    def saveFile(self, fileName):
+        with open(fileName, 'wb') as f:
+            f.write(self.image)
+
+    # The blocked flags are copied out of the image, so a shared map file
+    # is never changed
+    def setWalkable(self, i, j, walkable):
+        blocked = bytearray(self.blocked)
+        blocked[j*self.width + i] = 0 if walkable else 1
+        self.blocked = blocked
+        self.blockedSum = Map.buildBlockedSum(blocked, self.width, self.height)
+        self.navField = None
+        self.blockedGrid = None
+        self.blockedSumGrid = None
+        self.crc = None
+
+    def isWalkable(self, i, j):
+        return not self.blocked[j*self.width + i]
+
+    # Checksum of what the game sees of a map, its size and walls. Snapshots
+    # and replays hold it, so they are not loaded on another map
+    def getCrc(self):
+        if self.crc == None:
+            size = struct.pack('<IIH', self.width, self.height, self.gridSize)
+            self.crc = zlib.crc32(self.blocked, zlib.crc32(size))
+        return self.crc
+
+    # NavField shared by every map with the same walls
+    def getNavField(self):
+        if self.navField == None:
+            self.navField = NavField.get(self)
+        return self.navField
+
+    # Number of blocked cells with i0 <= i <= i1 and j0 <= j <= j1
+    def countBlocked(self, i0, j0, i1, j1):
+        w = self.width + 1
+        s = self.blockedSum
+        return s[(j1+1)*w + i1+1] - s[j0*w + i1+1] - s[(j1+1)*w + i0] + s[j0*w + i0]
 
     def collide(self, obj):
-        if obj.pos.x - obj.width/2 < 0 or obj.pos.x + obj.width/2 > self.gridSize * self.width \
-                or obj.pos.y - obj.height/2 < 0 or obj.pos.y + obj.height/2 > self.gridSize * self.height:
-                    return True
-        for i in range(int((obj.pos.x - obj.width/2)/self.gridSize), int((obj.pos.x + obj.width/2)/self.gridSize)+1):
-            for j in range(int((obj.pos.y - obj.height/2)/self.gridSize), int((obj.pos.y + obj.height/2)/self.gridSize)+1):
-                if self.data[j][i].walkable == False:
+        left = obj.pos.x - obj.width/2
+        right = obj.pos.x + obj.width/2
+        top = obj.pos.y - obj.height/2
+        bottom = obj.pos.y + obj.height/2
+        if left < 0 or right > self.gridSize * self.width \
+                or top < 0 or bottom > self.gridSize * self.height:
                     return True
-        return False
+        return self.countBlocked(int(left/self.gridSize), int(top/self.gridSize),
+                min(int(right/self.gridSize), self.width - 1),
+                min(int(bottom/self.gridSize), self.height - 1)) > 0
+
+    # NumPy bool array indexed [j][i], True for cells that are not walkable
+    def getBlockedGrid(self):
+        if self.blockedGrid is None:
+            self.blockedGrid = np.frombuffer(self.blocked, dtype = np.uint8).reshape(self.height, self.width).astype(bool)
+        return self.blockedGrid
+
+    # Shares the memory of blockedSum. The sums are uint32, the differences
+    # in collideArray wrap around but the rectangle counts come out exact
+    def getBlockedSumGrid(self):
+        if self.blockedSumGrid is None:
+            self.blockedSumGrid = np.frombuffer(self.blockedSum, dtype = np.uint32).reshape(self.height + 1, self.width + 1)
+        return self.blockedSumGrid
+
+    # Vectorized collide for arrays of square objects
+    def collideArray(self, x, y, size):
+        half = size / 2
+        left = x - half
+        right = x + half
+        top = y - half
+        bottom = y + half
+        ret = (left < 0) | (right > self.gridSize * self.width) | \
+                (top < 0) | (bottom > self.gridSize * self.height)
+        i0 = np.clip((left / self.gridSize).astype(int), 0, self.width - 1)
+        i1 = np.clip((right / self.gridSize).astype(int), 0, self.width - 1) + 1
+        j0 = np.clip((top / self.gridSize).astype(int), 0, self.height - 1)
+        j1 = np.clip((bottom / self.gridSize).astype(int), 0, self.height - 1) + 1
+        s = self.getBlockedSumGrid()
+        return ret | (s[j1, i1] - s[j0, i1] - s[j1, i0] + s[j0, i0] > 0)
+
+    # Fraction of the way from (x0, y0) to (x1, y1) where the point first
+    # enters a blocked cell or leaves the map, None if it never does. The
+    # cells on the segment are visited one grid line at a time (DDA)
+    def traceRay(self, x0, y0, x1, y1):
+        gs = self.gridSize
+        width = self.width
+        i = int(x0 // gs)
+        j = int(y0 // gs)
+        if i < 0 or i >= width or j < 0 or j >= self.height or self.blocked[j*width + i]:
+            return 0
+        dx = x1 - x0
+        dy = y1 - y0
+        if dx > 0:
+            stepI = 1
+            tMaxX = ((i + 1)*gs - x0) / dx
+            tDeltaX = gs / dx
+        elif dx < 0:
+            stepI = -1
+            tMaxX = (i*gs - x0) / dx
+            tDeltaX = -gs / dx
+        else:
+            stepI = 0
+            tMaxX = tDeltaX = math.inf
+        if dy > 0:
+            stepJ = 1
+            tMaxY = ((j + 1)*gs - y0) / dy
+            tDeltaY = gs / dy
+        elif dy < 0:
+            stepJ = -1
+            tMaxY = (j*gs - y0) / dy
+            tDeltaY = -gs / dy
+        else:
+            stepJ = 0
+            tMaxY = tDeltaY = math.inf
+        while True:
+            if tMaxX < tMaxY:
+                t = tMaxX
+                i += stepI
+                tMaxX += tDeltaX
+            else:
+                t = tMaxY
+                j += stepJ
+                tMaxY += tDeltaY
+            if t > 1:
+                return None
+            if i < 0 or i >= width or j < 0 or j >= self.height or self.blocked[j*width + i]:
+                return t
+
+    # traceRay for a square of size moving from (x0, y0) to (x1, y1), the
+    # first time one of its corners runs into a wall
+    def sweep(self, x0, y0, x1, y1, size):
+        half = size / 2
+        ret = None
+        for cx in (-half, half):
+            for cy in (-half, half):
+                t = self.traceRay(x0 + cx, y0 + cy, x1 + cx, y1 + cy)
+                if t != None and (ret == None or t < ret):
+                    ret = t
+        return ret
+
+    def isBlockedArray(self, i, j):
+        grid = self.getBlockedGrid()
+        inside = (i >= 0) & (i < self.width) & (j >= 0) & (j < self.height)
+        return ~inside | grid[np.clip(j, 0, self.height - 1), np.clip(i, 0, self.width - 1)]
+
+    # Vectorized traceRay, inf where the segment is clear. All rays take a
+    # step per iteration and the ones that hit or end drop out
+    def traceRayArray(self, x0, y0, x1, y1):
+        gs = self.gridSize
+        i = np.floor(x0 / gs).astype(int)
+        j = np.floor(y0 / gs).astype(int)
+        dx = x1 - x0
+        dy = y1 - y0
+        stepI = np.sign(dx).astype(int)
+        stepJ = np.sign(dy).astype(int)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            tDeltaX = np.where(dx != 0, gs / np.abs(dx), np.inf)
+            tDeltaY = np.where(dy != 0, gs / np.abs(dy), np.inf)
+            tMaxX = np.where(dx > 0, ((i + 1)*gs - x0) / dx, np.where(dx < 0, (i*gs - x0) / dx, np.inf))
+            tMaxY = np.where(dy > 0, ((j + 1)*gs - y0) / dy, np.where(dy < 0, (j*gs - y0) / dy, np.inf))
+        ret = np.full(len(x0), np.inf)
+        hit = self.isBlockedArray(i, j)
+        ret[hit] = 0
+        active = np.nonzero(~hit)[0]
+        while len(active) > 0:
+            useX = tMaxX[active] < tMaxY[active]
+            t = np.where(useX, tMaxX[active], tMaxY[active])
+            ax = active[useX]
+            ay = active[~useX]
+            i[ax] += stepI[ax]
+            tMaxX[ax] += tDeltaX[ax]
+            j[ay] += stepJ[ay]
+            tMaxY[ay] += tDeltaY[ay]
+            inRange = t <= 1
+            hit = inRange & self.isBlockedArray(i[active], j[active])
+            ret[active[hit]] = t[hit]
+            active = active[inRange & ~hit]
+        return ret
+
+    def sweepArray(self, x0, y0, x1, y1, size):
+        half = size / 2
+        ret = np.full(len(x0), np.inf)
+        for cx in (-1, 1):
+            for cy in (-1, 1):
+                ret = np.minimum(ret, self.traceRayArray(x0 + cx*half, y0 + cy*half, x1 + cx*half, y1 + cy*half))
+        return ret
+
+    # Batch queries over many rays. With a NumPy array among the arguments
+    # all rays are traced together by traceRayArray and NumPy arrays come
+    # back, otherwise they are traced one by one by traceRay and lists come
+    # back. Scalars are used for every ray, so one origin can cast many
+    @staticmethod
+    def isArrayArgs(args):
+        return np != None and any(isinstance(v, np.ndarray) for v in args)
+
+    @staticmethod
+    def listArgs(args):
+        n = max((len(v) for v in args if isinstance(v, (list, tuple))), default = 1)
+        return [v if isinstance(v, (list, tuple)) else [v]*n for v in args]
+
+    # Distance from each origin along its angle to the first wall or the
+    # edge of the map, maxDistance when there is none that close
+    def raycast(self, x0, y0, angles, maxDistance):
+        if self.isArrayArgs((x0, y0, angles)):
+            x0, y0, angles = np.broadcast_arrays(np.asarray(x0, dtype = float), np.asarray(y0, dtype = float), np.asarray(angles, dtype = float))
+            t = self.traceRayArray(x0, y0, x0 + np.cos(angles)*maxDistance, y0 + np.sin(angles)*maxDistance)
+            return np.where(np.isinf(t), maxDistance, t*maxDistance)
+        ret = []
+        for x, y, angle in zip(*self.listArgs((x0, y0, angles))):
+            t = self.traceRay(x, y, x + math.cos(angle)*maxDistance, y + math.sin(angle)*maxDistance)
+            ret.append(maxDistance if t == None else t*maxDistance)
+        return ret
+
+    # True where nothing blocks the way from (x0, y0) to (x1, y1)
+    def lineOfSight(self, x0, y0, x1, y1):
+        if self.isArrayArgs((x0, y0, x1, y1)):
+            x0, y0, x1, y1 = np.broadcast_arrays(*[np.asarray(v, dtype = float) for v in (x0, y0, x1, y1)])
+            return np.isinf(self.traceRayArray(x0, y0, x1, y1))
+        return [self.traceRay(x, y, tx, ty) == None for x, y, tx, ty in zip(*self.listArgs((x0, y0, x1, y1)))]
+
+    # Tile ids of chunk (ci, cj), row by row with chunkSize tiles a row.
+    # The view is made when the chunk is first used
+    def getChunk(self, ci, cj):
+        key = cj*self.chunkColumns + ci
+        chunk = self.chunks.get(key)
+        if chunk == None:
+            size = 2 * self.chunkSize * self.chunkSize
+            offset = self.tileOffset + key * size
+            chunk = memoryview(self.image)[offset:offset + size].cast('H')
+            if sys.byteorder != 'little':
+                chunk = array('H', chunk.tobytes())
+                chunk.byteswap()
+            self.chunks[key] = chunk
+        return chunk
+
+    def getTile(self, i, j):
+        c = self.chunkSize
+        return self.getChunk(i // c, j // c)[(j % c)*c + i % c]
+
+    # Tile ids of one chunk, for clients that only draw what is near them
+    def getChunkInfo(self, ci, cj):
+        c = self.chunkSize
+        chunk = self.getChunk(ci, cj)
+        tileInfo = []
+        for j in range(min(c, self.height - cj*c)):
+            tileInfo.append(chunk[j*c:j*c + min(c, self.width - ci*c)].tolist())
+        return {'chunk': [ci, cj], 'tile': tileInfo}
 
     def getInfo(self):
+        if self.info != None:
+            return self.info
         mapInfo = {}
         tileInfo = []
-        for row in self.data:
+        for j in range(self.height):
             rowInfo = []
-            for mapCell in row:
-                rowInfo.append(mapCell.tile)
+            for i in range(self.width):
+                rowInfo.append(self.getTile(i, j))
             tileInfo.append(rowInfo)
         mapInfo['tile'] = tileInfo
+        self.info = mapInfo
 
         return mapInfo
     
-    def getRandomWalkableCoord(self):
+    def getRandomWalkableCoord(self, rng = random):
         while True:
-            i = random.randrange(0, self.height)
-            j = random.randrange(0, self.width)
-            if self.data[i][j].walkable:
+            i = rng.randrange(0, self.height)
+            j = rng.randrange(0, self.width)
+            if not self.blocked[i*self.width + j]:
                 return (j*self.gridSize + self.gridSize/2, i*self.gridSize + self.gridSize/2)
     
+    # Tiles of the first layer with ids above 100 are walls
     def loadJson(self, fileName):
         with open(fileName) as f:
             jsonData = json.load(f)
-            layer = jsonData['layers'][0]['data']
-            for i in range(self.height):
-                for j in range(self.width):
-                    tileId = layer[i*self.width + j]
-                    if tileId > 100:
-                        self.data[i][j].walkable = False
-                    else:
-                        self.data[i][j].walkable = True
+        width = jsonData['width']
+        height = jsonData['height']
+        layer = [tileId & self.tileIdMask for tileId in jsonData['layers'][0]['data']]
+        if layer and max(layer) > 0xffff:
+            raise ValueError("Tile id {} does not fit in a map image".format(max(layer)))
+        blocked = bytearray(1 if tileId > 100 else 0 for tileId in layer)
+        self.loadImage(Map.packImage(width, height, blocked, layer, jsonData.get('tilewidth', GRID_SIZE)))
+
+# Distances in cells to a target cell over the walkable tiles, from a
+# breadth first search out to maxDistance cells. A field is a bytearray
+# window centered on its target, 255 where the target can not be reached
+# in maxDistance steps. Fields are searched the first time a target is
+# asked for, and the last maxFields are kept. Maps with the same walls
+# share one NavField, so the bots of every game on a map share the work
+class NavField:
+    shared = {}
+    unreachable = 255
+    neighbours = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+    def __init__(self, blocked, width, height, gridSize, maxDistance = 48, maxFields = 256):
+        self.blocked = blocked
+        self.width = width
+        self.height = height
+        self.gridSize = gridSize
+        self.radius = min(maxDistance, self.unreachable - 1)
+        self.side = 2*self.radius + 1
+        self.maxFields = maxFields
+        self.fields = collections.OrderedDict()
+        self.searches = 0
+
+    @classmethod
+    def get(cls, gameMap):
+        key = (gameMap.width, gameMap.height, gameMap.gridSize, zlib.crc32(gameMap.blocked))
+        navField = cls.shared.get(key)
+        if navField == None:
+            navField = cls(gameMap.blocked, gameMap.width, gameMap.height, gameMap.gridSize)
+            cls.shared[key] = navField
+        return navField
+
+    def getField(self, ti, tj):
+        key = tj*self.width + ti
+        field = self.fields.get(key)
+        if field != None:
+            self.fields.move_to_end(key)
+            return field
+        field = self.search(ti, tj)
+        self.fields[key] = field
+        if len(self.fields) > self.maxFields:
+            self.fields.popitem(last = False)
+        return field
+
+    def search(self, ti, tj):
+        self.searches += 1
+        r = self.radius
+        side = self.side
+        width = self.width
+        height = self.height
+        blocked = self.blocked
+        field = bytearray([self.unreachable]) * (side*side)
+        if ti < 0 or ti >= width or tj < 0 or tj >= height or blocked[tj*width + ti]:
+            return field
+        field[r*side + r] = 0
+        frontier = [(ti, tj)]
+        d = 0
+        while frontier and d < r:
+            d += 1
+            nextFrontier = []
+            for i, j in frontier:
+                for di, dj in self.neighbours:
+                    ni = i + di
+                    nj = j + dj
+                    if 0 <= ni < width and 0 <= nj < height:
+                        idx = (nj - tj + r)*side + ni - ti + r
+                        if field[idx] == self.unreachable and not blocked[nj*width + ni]:
+                            field[idx] = d
+                            nextFrontier.append((ni, nj))
+            frontier = nextFrontier
+        return field
+
+    def getDistance(self, field, ti, tj, i, j):
+        r = self.radius
+        wi = i - ti + r
+        wj = j - tj + r
+        if wi < 0 or wi >= self.side or wj < 0 or wj >= self.side:
+            return self.unreachable
+        return field[wj*self.side + wi]
+
+    # Up to steps cells on a shortest way from (i, j) to (ti, tj), the
+    # nearest first. Empty when already there or out of reach
+    def getPath(self, ti, tj, i, j, steps):
+        field = self.getField(ti, tj)
+        d = self.getDistance(field, ti, tj, i, j)
+        path = []
+        while 0 < d < self.unreachable and len(path) < steps:
+            for di, dj in self.neighbours:
+                if self.getDistance(field, ti, tj, i + di, j + dj) == d - 1:
+                    i += di
+                    j += dj
+                    break
+            d -= 1
+            path.append((i, j))
+        return path
+
+    def getInfo(self):
+        ret = {}
+        ret['fields'] = len(self.fields)
+        ret['searches'] = self.searches
+        return ret
+
+# Uniform grid over object centers, so proximity tests only look at the
+# neighbouring cells instead of every object in the game
+class SpatialHash:
+    def __init__(self, cellSize = GRID_SIZE):
+        self.cellSize = cellSize
+        self.cells = {}
+        # Largest object width inserted, queries are widened by it so that
+        # anything whose edge reaches the query radius is returned
+        self.maxSize = 0
+
+    def getCell(self, x, y):
+        return (int(x // self.cellSize), int(y // self.cellSize))
+
+    def insert(self, obj):
+        cell = self.getCell(obj.pos.x, obj.pos.y)
+        obj.gridCell = cell
+        if cell not in self.cells:
+            self.cells[cell] = set()
+        self.cells[cell].add(obj)
+        self.maxSize = max(self.maxSize, obj.width)
+
+    def remove(self, obj):
+        bucket = self.cells.get(obj.gridCell)
+        if bucket != None:
+            bucket.discard(obj)
+            if not bucket:
+                del self.cells[obj.gridCell]
+        obj.gridCell = None
+
+    def update(self, obj):
+        if self.getCell(obj.pos.x, obj.pos.y) != obj.gridCell:
+            self.remove(obj)
+            self.insert(obj)
+
+    def query(self, x, y, radius):
+        radius += self.maxSize
+        x0, y0 = self.getCell(x - radius, y - radius)
+        x1, y1 = self.getCell(x + radius, y + radius)
+        ret = []
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                bucket = self.cells.get((i, j))
+                if bucket:
+                    ret.extend(bucket)
+        return ret
 
 class Weapon:
     def __init__(self):
@@ -136,29 +684,28 @@ class Weapon:
         self.possibleFeatures = set(["bounce", "penetrate", "zigzag", "variantSpeed", "doubleLength"])
         self.features = {}
 
-    def addFeature(self, feature):
-        self.features[feature] = time.time()
+    # features maps a feature to the game time it was added, Game.addFeature
+    # takes it away again after featureLifetime
+    def addFeature(self, feature, currTime = 0):
+        self.features[feature] = currTime
+
+    def removeFeature(self, feature):
+        self.features.pop(feature, None)
 
-    def fire(self, pos, angle, player, currTime, id, checkGap = True):
+    # Bullets come from pool when it is given
+    def fire(self, pos, angle, player, currTime, id, checkGap = True, rng = random, pool = None):
         if (not checkGap) or currTime - self.lastFire > self.gap:
-            b = Bullet()
+            b = pool.get() if pool != None else Bullet()
             b.setPos(pos)
             b.setSpeed(self.speed)
-            b.setAngle(angle + self.jitter*random.uniform(-1,1))
+            b.setAngle(angle + self.jitter*rng.uniform(-1,1))
             b.id = id
             b.damage = self.damage
             b.player = player.id
             b.width = self.size
             b.height = self.size
             b.length = self.length
-            expiredFeatures = []
-            for feature in self.features:
-                if self.features[feature] < time.time() - 60:
-                    expiredFeatures.append(feature)
-                else:
-                    b.features.add(feature)
-            for feature in expiredFeatures:
-                self.features.pop(feature)
+            b.features.update(self.features)
             if b.hasFeature('doubleLength'):
                 b.length *= 2
             self.lastFire = currTime
@@ -229,11 +776,11 @@ class WeaponFg42(Weapon):
         self.weight = 20
         self.jitter = 0.1
 
-    def fire(self, pos, angle, player, currTime, id):
+    def fire(self, pos, angle, player, currTime, id, rng = random, pool = None):
         if currTime - self.lastFire > self.gap:
             ret = []
             for i in range(5):
-                b = Weapon.fire(self, pos, angle+0.1*i-0.2, player, currTime, id, checkGap = False)
+                b = Weapon.fire(self, pos, angle+0.1*i-0.2, player, currTime, id, checkGap = False, rng = rng, pool = pool)
                 if b:
                     id += 1
                     ret += b
@@ -251,49 +798,80 @@ class WeaponAr(Weapon):
         self.speed = 350
         self.length = 800
 
+# Entities are allocated many times per frame, so they use __slots__ and
+# move their pos in place instead of creating new Points.
+# info caches getInfo for entities that stay the same for many frames, it
+# is set to None whenever a field in it changes, and a new dict is built
+# next time. The cached dict is never changed, so it can be kept by
+# DeltaEncoder and the serializers as the state of that frame
 class GameObject:
+    __slots__ = ('id', 'pos', 'moveDestination', 'moveAngle', 'speed', 'width', 'height', 'gridCell', 'info')
+
     def __init__(self):
-        self.id = 1
         self.pos = Point()
         self.moveDestination = Point()
+        GameObject.reset(self)
+
+    # Back to the state of a new object without allocating, for ObjectPool
+    def reset(self):
+        self.id = 1
+        self.pos.set(0, 0)
+        self.moveDestination.set(0, 0)
         self.moveAngle = 0
         self.speed = 0
         self.width = 64
         self.height = 64
+        self.gridCell = None
+        self.info = None
+
+    def setDirty(self):
+        self.info = None
 
     def setPos(self, px, y = 0):
+        self.info = None
         if type(px) == Point:
-            self.pos = px.copy()
+            self.pos.set(px.x, px.y)
         else:
             self.pos.x = px
             self.pos.y = y
 
     def setMove(self, px, y, moveSpeed):
         if type(px) == Point:
-            self.moveDestination = p.copy()
+            self.moveDestination.set(px.x, px.y)
         else:
-            self.moveDestination = Point(px, y)
+            self.moveDestination.set(px, y)
         self.moveAngle = self.pos.getAngle(self.moveDestination)
         self.speed = moveSpeed
+        self.info = None
     
     def setAngle(self, angle):
         self.moveAngle = angle
+        self.info = None
 
     def setSpeed(self, speed):
         self.speed = speed
+        self.info = None
     
     def move(self, time, m):
         if time != 0:
-            newPos = self.pos.getShift(self.moveAngle, self.speed*time)
-            oldPos = self.pos.copy()
-            self.pos = newPos
+            self.info = None
+            pos = self.pos
+            dest = self.moveDestination
+            oldX = pos.x
+            oldY = pos.y
+            length = self.speed*time
+            pos.x = length*math.cos(self.moveAngle) + oldX
+            pos.y = length*math.sin(self.moveAngle) + oldY
             # If already arrived at position or collide, stop
-            if (self.pos.getDist(self.moveDestination) > oldPos.getDist(self.moveDestination) and type(self) == Player) or \
+            if (pos.getDist(dest) > ((dest.x - oldX)**2 + (dest.y - oldY)**2)**0.5 and type(self) == Player) or \
                     m.collide(self):
-                self.pos = oldPos
+                pos.x = oldX
+                pos.y = oldY
                 self.speed = 0
 
 class Player(GameObject):
+    __slots__ = ('name', 'weapon', 'moveSpeed', 'hp', 'lastAction', 'channel', 'dead', 'deadFrame', 'kill', 'death', 'features')
+
     def __init__(self):
         GameObject.__init__(self)
         self.name = ""
@@ -304,6 +882,7 @@ class Player(GameObject):
         self.id = 0
         self.hp = 100
         self.lastAction = None
+        self.channel = None
         self.dead = False
         self.deadFrame = 0
         self.kill = 0
@@ -317,19 +896,23 @@ class Player(GameObject):
         self.weapon = WeaponBase()
         self.features = {}
         self.dead = False
+        self.info = None
+
+    # Same as Weapon.addFeature
+    def addFeature(self, feature, currTime = 0):
+        self.features[feature] = currTime
+        self.info = None
 
-    def addFeature(self, feature):
-        self.features[feature] = time.time()
+    def removeFeature(self, feature):
+        if self.features.pop(feature, None) != None:
+            self.info = None
 
     def hasFeature(self, feature):
-        if feature in self.features:
-            if self.features[feature] < time.time() - 60:
-                self.features.pop(feature)
-                return False
-            return True
-        return False
+        return feature in self.features
 
     def getInfo(self):
+        if self.info != None:
+            return self.info
         ret = {}
         ret['x'] = self.pos.x
         ret['y'] = self.pos.y
@@ -342,27 +925,40 @@ class Player(GameObject):
         ret['dead'] = self.dead
         ret['kill'] = self.kill
         ret['death'] = self.death
-        ret['features'] = self.features
+        ret['features'] = dict(self.features)
+        self.info = ret
 
         return ret
 
     def move(self, time, m):
         if time != 0:
             speed = self.speed
-            newPos = self.pos.getShift(self.moveAngle, speed*time)
-            oldPos = self.pos.copy()
-            self.pos = newPos
+            if speed != 0:
+                self.info = None
+            pos = self.pos
+            dest = self.moveDestination
+            oldX = pos.x
+            oldY = pos.y
+            dx = speed*time*math.cos(self.moveAngle)
+            dy = speed*time*math.sin(self.moveAngle)
+            pos.x = dx + oldX
+            pos.y = dy + oldY
             # If already arrived at position or collide, stop
-            if (self.pos.getDist(self.moveDestination) > oldPos.getDist(self.moveDestination)):
-                self.pos = oldPos
+            if pos.getDist(dest) > ((dest.x - oldX)**2 + (dest.y - oldY)**2)**0.5:
+                pos.x = oldX
+                pos.y = oldY
                 self.speed = 0
             if m.collide(self):
-                self.pos = oldPos.getShiftX(self.moveAngle, speed*time)
+                # Slide along the wall on one axis
+                pos.x = dx + oldX
+                pos.y = oldY
                 if m.collide(self):
-                    self.pos = oldPos.getShiftY(self.moveAngle, speed*time)
+                    pos.x = oldX
+                    pos.y = dy + oldY
                     if m.collide(self):
                         self.speed = 0
-                        self.pos = oldPos
+                        pos.x = oldX
+                        pos.y = oldY
                         return False
                     else:
                         return True
@@ -373,14 +969,26 @@ class Player(GameObject):
         return False
 
 class Bullet(GameObject):
+    __slots__ = ('length', 'damage', 'features', 'player', 'lastX', 'lastY')
+
     def __init__(self):
+        self.features = set()
         GameObject.__init__(self)
+        self.reset()
+
+    def reset(self):
+        GameObject.reset(self)
         self.speed = 200
         self.width = 10
         self.height = 10
         self.length = 100
         self.damage = 0
-        self.features = set()
+        self.features.clear()
+        self.player = None
+        # Where the last move started, swept hit tests use the segment
+        # from here to pos
+        self.lastX = 0
+        self.lastY = 0
     
     def getInfo(self):
         ret = {}
@@ -395,57 +1003,304 @@ class Bullet(GameObject):
 
     def hasFeature(self, feature):
         return feature in self.features
-    def move(self, time, m):
+    # With swept, walls between the old and the new position are found
+    # too, and a bullet stopped by a wall is left at the wall
+    def move(self, time, m, rng = random, swept = False):
+        pos = self.pos
+        self.lastX = pos.x
+        self.lastY = pos.y
         if time != 0:
-            newPos = self.pos.getShift(self.moveAngle, self.speed*time)
-            oldPos = self.pos.copy()
-            self.pos = newPos
+            oldX = pos.x
+            oldY = pos.y
+            length = self.speed*time
+            newX = length*math.cos(self.moveAngle) + oldX
+            newY = length*math.sin(self.moveAngle) + oldY
+            penetrate = self.hasFeature('penetrate')
+            clamped = False
+            # Once the bullet moves further than its size in a frame, the
+            # old and new boxes no longer overlap and it could skip a wall
+            if swept and not penetrate and max(abs(newX - oldX), abs(newY - oldY)) > self.width:
+                t = m.sweep(oldX, oldY, newX, newY, self.width)
+                if t != None:
+                    # Stop a hair past the wall, so the box is in it
+                    t = min(1, t + 0.01 / abs(length))
+                    newX = oldX + (newX - oldX)*t
+                    newY = oldY + (newY - oldY)*t
+                    clamped = True
+            pos.x = newX
+            pos.y = newY
             if self.hasFeature("zigzag"):
-                self.moveAngle = self.moveAngle + 0.2 * random.uniform(-1,1)
+                self.moveAngle = self.moveAngle + 0.2 * rng.uniform(-1,1)
             if self.hasFeature("variantSpeed"):
-                self.speed = self.speed + 30 * random.uniform(-1,1)
+                self.speed = self.speed + 30 * rng.uniform(-1,1)
             # If already arrived at position or collide, stop
-            if not self.hasFeature('penetrate') and m.collide(self):
+            if not penetrate and (clamped or m.collide(self)):
                 if self.hasFeature('bounce') == True:
-                    bouncePos = oldPos.copy()
-                    self.pos = Point(newPos.x, oldPos.y)
+                    bounceToX = oldX
+                    bounceToY = oldY
+                    pos.x = newX
+                    pos.y = oldY
                     bounceX = False
                     if m.collide(self):
-                        bouncePos.y = 2*newPos.y - oldPos.y
+                        bounceToY = 2*newY - oldY
                         bounceX = True
-                    self.pos = Point(oldPos.x, newPos.y)
+                    pos.x = oldX
+                    pos.y = newY
                     if m.collide(self):
                         if bounceX:
                             self.speed = 0
                             return False
-                        bouncePos.x = 2*newPos.x - oldPos.x
-                    self.pos = newPos
-                    self.moveAngle = newPos.getAngle(bouncePos)
+                        bounceToX = 2*newX - oldX
+                    pos.x = newX
+                    pos.y = newY
+                    self.moveAngle = math.atan2(bounceToY - newY, bounceToX - newX)
                     return True
-                self.pos = oldPos
+                if not swept:
+                    pos.x = oldX
+                    pos.y = oldY
                 self.speed = 0
                 return False
             return True
         return False
 
+# Struct of arrays replacement for a list of Bullet, all live bullets are
+# moved with a few NumPy operations per frame. Behavior matches Bullet.move
+class BulletStore:
+    fields = [('x', float), ('y', float), ('angle', float), ('speed', float),
+            ('length', float), ('damage', int), ('size', int),
+            ('id', int), ('player', int), ('features', int),
+            ('lastX', float), ('lastY', float)]
+
+    def __init__(self, capacity = 256, seed = None):
+        self.count = 0
+        self.capacity = 0
+        self.rng = np.random.default_rng(seed)
+        for name, dtype in self.fields:
+            setattr(self, name, np.zeros(0, dtype = dtype))
+        self.reserve(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity):
+        if capacity > self.capacity:
+            capacity = max(capacity, 2*self.capacity)
+            for name, dtype in self.fields:
+                arr = np.zeros(capacity, dtype = dtype)
+                arr[:self.count] = getattr(self, name)[:self.count]
+                setattr(self, name, arr)
+            self.capacity = capacity
+
+    def add(self, b):
+        self.reserve(self.count + 1)
+        i = self.count
+        self.x[i] = b.pos.x
+        self.y[i] = b.pos.y
+        self.lastX[i] = b.pos.x
+        self.lastY[i] = b.pos.y
+        self.angle[i] = b.moveAngle
+        self.speed[i] = b.speed
+        self.length[i] = b.length
+        self.damage[i] = b.damage
+        self.size[i] = b.width
+        self.id[i] = b.id
+        self.player[i] = b.player
+        features = 0
+        for feature in b.features:
+            features |= BULLET_FEATURE_BITS.get(feature, 0)
+        self.features[i] = features
+        self.count += 1
+
+    def hasFeature(self, feature):
+        return (self.features[:self.count] & BULLET_FEATURE_BITS[feature]) != 0
+
+    # Keep only the bullets where mask is True
+    def compact(self, mask):
+        n = self.count
+        keep = np.count_nonzero(mask)
+        if keep != n:
+            for name, dtype in self.fields:
+                arr = getattr(self, name)
+                arr[:keep] = arr[:n][mask]
+            self.count = keep
+
+    # With swept, bullets stopped by a wall are kept at the wall with no
+    # length left, so getHitPairs still sees their last segment
+    def update(self, time, m, swept = False):
+        n = self.count
+        if n == 0 or time == 0:
+            return
+        x = self.x[:n]
+        y = self.y[:n]
+        self.lastX[:n] = x
+        self.lastY[:n] = y
+        angle = self.angle[:n]
+        speed = self.speed[:n]
+        size = self.size[:n]
+        newX = x + speed*time*np.cos(angle)
+        newY = y + speed*time*np.sin(angle)
+        penetrate = self.hasFeature("penetrate")
+        clamped = np.zeros(n, dtype = bool)
+        if swept:
+            far = np.nonzero((np.maximum(np.abs(newX - x), np.abs(newY - y)) > size) & ~penetrate)[0]
+            if len(far) > 0:
+                t = m.sweepArray(x[far], y[far], newX[far], newY[far], size[far])
+                hit = t <= 1
+                far = far[hit]
+                t = np.minimum(1, t[hit] + 0.01 / np.abs(speed[far]*time))
+                newX[far] = x[far] + (newX[far] - x[far])*t
+                newY[far] = y[far] + (newY[far] - y[far])*t
+                clamped[far] = True
+
+        zigzag = self.hasFeature("zigzag")
+        num = np.count_nonzero(zigzag)
+        if num > 0:
+            angle[zigzag] += 0.2 * self.rng.uniform(-1, 1, num)
+        variant = self.hasFeature("variantSpeed")
+        num = np.count_nonzero(variant)
+        if num > 0:
+            speed[variant] += 30 * self.rng.uniform(-1, 1, num)
+
+        collide = (clamped | m.collideArray(newX, newY, size)) & ~penetrate
+        alive = ~collide
+        bounce = np.nonzero(collide & self.hasFeature("bounce"))[0]
+        if len(bounce) > 0:
+            oldX = x[bounce]
+            oldY = y[bounce]
+            bx = newX[bounce]
+            by = newY[bounce]
+            bounceX = m.collideArray(bx, oldY, size[bounce])
+            bounceY = m.collideArray(oldX, by, size[bounce])
+            # Blocked on both axis, the bullet stops
+            stuck = bounceX & bounceY
+            bouncePosX = np.where(bounceY, 2*bx - oldX, oldX)
+            bouncePosY = np.where(bounceX, 2*by - oldY, oldY)
+            angle[bounce] = np.where(stuck, angle[bounce], np.arctan2(bouncePosY - by, bouncePosX - bx))
+            alive[bounce] = ~stuck
+
+        x[:] = newX
+        y[:] = newY
+        length = self.length[:n]
+        length -= np.abs(speed * time)
+        if swept:
+            length[~alive] = 0
+            self.compact(~alive | (length > 0))
+        else:
+            self.compact(alive & (length > 0))
+
+    # (bullet index, player index) pairs within hit distance, ordered by
+    # bullet first and then by the order of players. With swept, the
+    # distance is to the segment the bullet moved along in the last update.
+    # Bullets are bucketed by the cell of cellSize they are in, and only
+    # the bullets in the cells around a player are tested against it
+    def getHitPairs(self, players, swept = False, cellSize = GRID_SIZE):
+        n = self.count
+        if n == 0 or len(players) == 0:
+            return []
+        px = np.array([p.pos.x for p in players])
+        py = np.array([p.pos.y for p in players])
+        pw = np.array([p.width for p in players], dtype = float)
+        pid = np.array([p.id for p in players])
+        x = self.x[:n]
+        y = self.y[:n]
+        size = self.size[:n]
+        # A bullet that hits is within reach of the player at its end point
+        reach = pw.max() + size.max()
+        if swept:
+            reach += np.hypot(x - self.lastX[:n], y - self.lastY[:n]).max()
+        if not np.isfinite(reach):
+            reach = 0
+
+        cellX = np.floor(x / cellSize).astype(np.int64)
+        cellY = np.floor(y / cellSize).astype(np.int64)
+        span = int(2*reach // cellSize) + 2
+        queryX = np.floor((px - reach) / cellSize).astype(np.int64)[:, None] + np.arange(span)
+        queryY = np.floor((py - reach) / cellSize).astype(np.int64)[:, None] + np.arange(span)
+        minY = min(cellY.min(), queryY.min())
+        rows = max(cellY.max(), queryY.max()) - minY + 1
+        keys = cellX * rows + (cellY - minY)
+        order = np.argsort(keys, kind = 'stable')
+        keys = keys[order]
+        # Every cell around every player, player by player
+        queryKeys = (queryX[:, :, None] * rows + (queryY[:, None, :] - minY)).ravel()
+        queryPlayer = np.repeat(np.arange(len(players)), span*span)
+        lo = np.searchsorted(keys, queryKeys, 'left')
+        counts = np.searchsorted(keys, queryKeys, 'right') - lo
+        total = int(counts.sum())
+        if total == 0:
+            return []
+        query = np.repeat(np.arange(len(queryKeys)), counts)
+        b = order[lo[query] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)]
+        p = queryPlayer[query]
+
+        if swept:
+            x0 = self.lastX[b]
+            y0 = self.lastY[b]
+            sx = x[b] - x0
+            sy = y[b] - y0
+            l2 = sx*sx + sy*sy
+            t = np.clip(((px[p] - x0)*sx + (py[p] - y0)*sy) / np.where(l2 > 0, l2, 1), 0, 1)
+            dx = px[p] - x0 - t*sx
+            dy = py[p] - y0 - t*sy
+        else:
+            dx = px[p] - x[b]
+            dy = py[p] - y[b]
+        hit = (np.sqrt(dx*dx + dy*dy) < pw[p] + size[b]) & (self.player[b] != pid[p])
+        b = b[hit]
+        p = p[hit]
+        sort = np.lexsort((p, b))
+        return list(zip(b[sort].tolist(), p[sort].tolist()))
+
+    def getInfoById(self, id):
+        idx = np.nonzero(self.id[:self.count] == id)[0]
+        if len(idx) == 0:
+            return None
+        i = int(idx[0])
+        return {'x':float(self.x[i]), 'y':float(self.y[i]), 'size':int(self.size[i]),
+                'angle':float(self.angle[i]), 'speed':float(self.speed[i]), 'id':id}
+
+    def getInfo(self):
+        n = self.count
+        ret = []
+        for x, y, size, angle, speed, id in zip(self.x[:n].tolist(), self.y[:n].tolist(),
+                self.size[:n].tolist(), self.angle[:n].tolist(), self.speed[:n].tolist(), self.id[:n].tolist()):
+            ret.append({'x':x, 'y':y, 'size':size, 'angle':angle, 'speed':speed, 'id':id})
+        return ret
+
 class Item(GameObject):
-    def __init__(self, itemType = None):
+    __slots__ = ('itemType', 'spawnFrame')
+
+    def __init__(self, itemType = None, rng = random):
         GameObject.__init__(self)
+        self.spawnFrame = 0
+        self.setType(itemType, rng)
+
+    def reset(self, itemType = None, rng = random):
+        GameObject.reset(self)
+        self.spawnFrame = 0
+        self.setType(itemType, rng)
+
+    def setType(self, itemType = None, rng = random):
         if itemType == None:
-            self.itemType = random.choices(['health', 'german_pistol', 'mp_43', 'm1_carbine', 'mp_40', 'fg_42'], weights = [4,1,1,1,1,1])[0]
+            self.itemType = rng.choices(['health', 'german_pistol', 'mp_43', 'm1_carbine', 'mp_40', 'fg_42'], weights = [4,1,1,1,1,1])[0]
         else:
             self.itemType = itemType
     
     def getInfo(self):
+        if self.info != None:
+            return self.info
         ret = {}
         ret['id'] = self.id
         ret['x'] = self.pos.x
         ret['y'] = self.pos.y
         ret['itemType'] = self.itemType
+        self.info = ret
         
         return ret
 
-    def buff(self, player):
+    def buff(self, player, game):
+        rng = game.rng
+        player.setDirty()
         if self.itemType == 'health':
             player.hp = min(player.hp + 20, 100)
         elif self.itemType == 'german_pistol':
@@ -459,48 +1314,529 @@ class Item(GameObject):
         elif self.itemType == 'fg_42':
             player.weapon = WeaponFg42()
         elif self.itemType == 'random_weapon_buff':
-            buff = random.choice(['bounce', 'penetrate', 'zigzag', 'variantSpeed', 'doubleLength'])
-            player.weapon.addFeature(buff)
+            buff = rng.choice(['bounce', 'penetrate', 'zigzag', 'variantSpeed', 'doubleLength'])
+            game.addFeature(player.weapon, buff)
         elif self.itemType == 'random_player_buff':
-            buff = random.choice(['defense', 'acceleration', 'full_health'])
+            buff = rng.choice(['defense', 'acceleration', 'full_health'])
             if buff == 'full_health':
                 player.hp = 100
             else:
-                player.addFeature(buff)
+                game.addFeature(player, buff)
             
 
-class Game:
+# Turns the action messages received in a tick into the actions to run.
+# Only the last move of a player in a tick is kept, since it overrides the
+# earlier ones, and shoots closer than minShootInterval are dropped before
+# they reach Weapon.fire
+class ActionIngest:
+    # Only the game itself adds and removes bots
+    internalActions = ('addBot', 'removeBot')
+    # Fields used as dict keys here and in the game's EntityRegistry
+    keyFields = ('player', 'channel')
+
+    def __init__(self, minShootInterval = 0.1):
+        self.minShootInterval = minShootInterval
+        self.lastShoot = {}
+        self.ingested = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def process(self, batches, currTime):
+        actions = []
+        moves = {}
+        for serializer, data in batches:
+            try:
+                batch = serializer.loads(data)
+            except ValueError:
+                print("Error on decoding actions", data)
+                self.dropped += 1
+                continue
+            if type(batch) != list:
+                batch = [batch]
+            for action in batch:
+                self.ingested += 1
+                if type(action) != dict or 'actionType' not in action:
+                    print("Error on input, get {}".format(action))
+                    self.dropped += 1
+                    continue
+                if any(key in action and not EntityRegistry.isKey(action[key]) for key in self.keyFields):
+                    print("Error on input, bad player or channel {}".format(action))
+                    self.dropped += 1
+                    continue
+                actionType = action['actionType']
+                if actionType in self.internalActions:
+                    self.dropped += 1
+                    continue
+                if actionType == 'move' and 'player' in action:
+                    if action['player'] in moves:
+                        actions[moves[action['player']]] = None
+                        self.coalesced += 1
+                    moves[action['player']] = len(actions)
+                elif actionType == 'shoot' and 'player' in action:
+                    if currTime - self.lastShoot.get(action['player'], -math.inf) < self.minShootInterval:
+                        self.dropped += 1
+                        continue
+                    self.lastShoot[action['player']] = currTime
+                actions.append(action)
+        if len(self.lastShoot) > 1000:
+            self.lastShoot = {p: t for p, t in self.lastShoot.items() if t > currTime - self.minShootInterval}
+        return [action for action in actions if action != None]
+
+    def getInfo(self):
+        ret = {}
+        ret['ingested'] = self.ingested
+        ret['coalesced'] = self.coalesced
+        ret['dropped'] = self.dropped
+        return ret
+
+# Hashed timing wheel keyed on frame numbers. A timer goes into slot
+# frame % size with the frame it is due, so scheduling and cancelling cost
+# the same however far ahead it is, and advancing only looks at the slots
+# of the frames that passed. Timers due in the same frame run in the order
+# they were scheduled, so a game plays the same every time
+class TimerWheel:
+    def __init__(self, currFrame = 0, size = 1024):
+        self.size = size
+        self.slots = [[] for i in range(size)]
+        self.currFrame = currFrame
+        self.seq = 0
+        self.count = 0
+
+    # Runs callback(*args) when frame is reached, at the earliest on the
+    # next advance. Returns the timer for cancel
+    def schedule(self, frame, callback, *args):
+        frame = max(frame, self.currFrame + 1)
+        timer = [frame, self.seq, callback, args]
+        self.seq += 1
+        self.count += 1
+        self.slots[frame % self.size].append(timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    # Run every timer due up to and including frame
+    def advance(self, frame):
+        if frame <= self.currFrame:
+            return
+        if frame - self.currFrame >= self.size:
+            indexes = range(self.size)
+        else:
+            indexes = [f % self.size for f in range(self.currFrame + 1, frame + 1)]
+        self.currFrame = frame
+        due = []
+        for idx in indexes:
+            slot = self.slots[idx]
+            if slot:
+                later = [timer for timer in slot if timer[0] > frame]
+                if len(later) != len(slot):
+                    due.extend(timer for timer in slot if timer[0] <= frame)
+                    self.slots[idx] = later
+        if due:
+            self.count -= len(due)
+            due.sort(key = lambda timer: (timer[0], timer[1]))
+            for frame, seq, callback, args in due:
+                if callback != None:
+                    callback(*args)
+
+# Free list of objects of cls. Bullets and items are created and dropped
+# every few frames, reusing them keeps the allocator and the gc out of the
+# frame. Objects from get(*args) are the same as cls(*args)
+class ObjectPool:
+    def __init__(self, cls, maxSize = 10000):
+        self.cls = cls
+        self.maxSize = maxSize
+        self.free = []
+        self.created = 0
+        self.reused = 0
+
+    def get(self, *args):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+            self.reused += 1
+            return obj
+        self.created += 1
+        return self.cls(*args)
+
+    def put(self, obj):
+        if len(self.free) < self.maxSize:
+            self.free.append(obj)
+
+    def getInfo(self):
+        ret = {}
+        ret['created'] = self.created
+        ret['reused'] = self.reused
+        ret['free'] = len(self.free)
+        return ret
+
+# id -> entity tables for every kind of entity and channel -> player, kept
+# in sync by Game whenever an entity is added or removed
+class EntityRegistry:
     def __init__(self):
-        self.width = 30
-        self.height = 30
+        self.players = {}
+        self.channels = {}
+        self.bullets = {}
+        self.items = {}
+
+    def addPlayer(self, p):
+        self.players[p.id] = p
+        # Bots have no channel
+        if p.channel != None:
+            self.channels[p.channel] = p
+
+    def removePlayer(self, p):
+        self.players.pop(p.id, None)
+        if self.channels.get(p.channel) is p:
+            del self.channels[p.channel]
+
+    def addBullet(self, b):
+        self.bullets[b.id] = b
+
+    def removeBullet(self, b):
+        self.bullets.pop(b.id, None)
+
+    def addItem(self, item):
+        self.items[item.id] = item
+
+    def removeItem(self, item):
+        self.items.pop(item.id, None)
+
+    # Ids and channels come from client json, anything else can not be
+    # one and may not even be hashable
+    @staticmethod
+    def isKey(key):
+        return type(key) == int or type(key) == str
+
+# Turns full dynamic game info into a stream of messages with a sequence
+# number. Every keyframeInterval messages, or when a client asks for it,
+# the full state is sent. In between only new entities, changed fields and
+# removed ids are sent. Bullets fly straight, so their x and y are left
+# out unless angle or speed changed and clients move them on their own
+class DeltaEncoder:
+    kinds = ['players', 'bullets', 'items']
+    extrapolated = {'bullets': ('x', 'y')}
+
+    def __init__(self, keyframeInterval = 20):
+        self.keyframeInterval = keyframeInterval
+        self.seq = 0
+        self.lastKeyframe = 0
+        self.needKeyframe = True
+        self.entities = {kind: {} for kind in self.kinds}
+
+    def requestKeyframe(self):
+        self.needKeyframe = True
+
+    def encode(self, info):
+        self.seq += 1
+        ret = {}
+        ret['infoType'] = 'dynamicGameDelta'
+        ret['seq'] = self.seq
+        ret['timestamp'] = info['timestamp']
+        if self.needKeyframe or self.seq - self.lastKeyframe >= self.keyframeInterval:
+            self.needKeyframe = False
+            self.lastKeyframe = self.seq
+            ret['keyframe'] = True
+            for kind in self.kinds:
+                ret[kind] = info[kind]
+                self.entities[kind] = {e['id']: e for e in info[kind]}
+            return ret
+
+        ret['keyframe'] = False
+        for kind in self.kinds:
+            prevEntities = self.entities[kind]
+            currEntities = {}
+            skip = self.extrapolated.get(kind, ())
+            changed = []
+            for e in info[kind]:
+                id = e['id']
+                prev = prevEntities.get(id)
+                if prev is e:
+                    # Cached info of an entity that did not change
+                    currEntities[id] = e
+                    continue
+                if prev == None:
+                    currEntities[id] = e
+                    changed.append(e)
+                    continue
+                diff = {}
+                for key, value in e.items():
+                    if key not in skip and prev[key] != value:
+                        diff[key] = value
+                if diff:
+                    for key in skip:
+                        diff[key] = e[key]
+                    diff['id'] = id
+                    changed.append(diff)
+                    currEntities[id] = e
+                else:
+                    # Keep the state the client extrapolates from
+                    currEntities[id] = prev
+            removed = [id for id in prevEntities if id not in currEntities]
+            self.entities[kind] = currEntities
+            ret[kind] = {'changed': changed, 'removed': removed}
+        return ret
+
+# Drives the players that have no channel. Each bot thinks once every
+# thinkFrames frames, spread over the frames by id. What it decides goes
+# through doActions like the actions of a human, so it is recorded, and a
+# replay plays it without running the bots again. A bot shoots the nearest
+# player it can see, or walks towards it, or wanders, along paths from the
+# NavField of the map. With count, rooms with humans are filled up with
+# bots to count players, and the bots leave with the last human
+class BotController:
+    def __init__(self, game, count = BOTS, thinkFrames = 15, seed = None):
+        self.game = game
+        self.count = count
+        self.thinkFrames = thinkFrames
+        self.sightRange = 600
+        # Cells of a path looked ahead for the furthest one in a straight line
+        self.lookahead = 6
+        self.rng = random.Random(seed)
+        self.nextThink = {}
+        self.goals = {}
+        self.botIndex = 1
+        self.decisions = 0
+
+    # Actions of the bots for this frame
+    def update(self):
+        game = self.game
+        actions = []
+        bots = []
+        humans = 0
+        for p in game.players:
+            if p.channel == None:
+                bots.append(p)
+            else:
+                humans += 1
+        if self.count:
+            if humans > 0 and humans + len(bots) < self.count:
+                actions.append({'actionType':'addBot', 'name':'bot{}'.format(self.botIndex)})
+                self.botIndex += 1
+            elif bots and (humans == 0 or humans + len(bots) > self.count):
+                bot = bots.pop()
+                self.nextThink.pop(bot.id, None)
+                self.goals.pop(bot.id, None)
+                actions.append({'actionType':'removeBot', 'player':bot.id})
+        currFrame = game.currFrame
+        thinking = []
+        for bot in bots:
+            nextThink = self.nextThink.get(bot.id)
+            if nextThink == None:
+                nextThink = currFrame + bot.id % self.thinkFrames
+            if currFrame >= nextThink:
+                nextThink = currFrame + self.thinkFrames
+                if not bot.dead:
+                    thinking.append(bot)
+            self.nextThink[bot.id] = nextThink
+        if not thinking:
+            return actions
+        # Whether each bot sees its target, in one batch for all of them
+        targets = [self.getNearestPlayer(bot) for bot in thinking]
+        seen = [(bot, target) for bot, target in zip(thinking, targets) if target != None]
+        visible = set()
+        if seen:
+            mask = game.gameMap.lineOfSight([bot.pos.x for bot, target in seen], [bot.pos.y for bot, target in seen],
+                    [target.pos.x for bot, target in seen], [target.pos.y for bot, target in seen])
+            visible = {bot.id for (bot, target), v in zip(seen, mask) if v}
+        for bot, target in zip(thinking, targets):
+            action = self.think(bot, target, bot.id in visible)
+            if action != None:
+                actions.append(action)
+        return actions
+
+    def think(self, bot, target, visible):
+        self.decisions += 1
+        gameMap = self.game.gameMap
+        x = bot.pos.x
+        y = bot.pos.y
+        if target != None:
+            if visible:
+                return {'actionType':'shoot', 'player':bot.id, 'x':target.pos.x, 'y':target.pos.y}
+            goalX = target.pos.x
+            goalY = target.pos.y
+        else:
+            goal = self.goals.get(bot.id)
+            if goal == None or (goal[0] - x)**2 + (goal[1] - y)**2 < gameMap.gridSize**2:
+                goal = self.getWanderGoal(bot)
+                self.goals[bot.id] = goal
+            goalX, goalY = goal
+        waypoint = self.getWaypoint(bot, goalX, goalY)
+        if waypoint == None:
+            # Out of reach, try another way next time
+            self.goals.pop(bot.id, None)
+            return None
+        if bot.speed != 0 and bot.moveDestination.x == waypoint[0] and bot.moveDestination.y == waypoint[1]:
+            return None
+        return {'actionType':'move', 'player':bot.id, 'x':waypoint[0], 'y':waypoint[1]}
+
+    # Nearest live player within sightRange. Rooms can be crowded, so the
+    # search starts close by and only widens when nobody is there
+    def getNearestPlayer(self, bot):
+        x = bot.pos.x
+        y = bot.pos.y
+        radius = self.sightRange / 4
+        while True:
+            target = None
+            targetDist = radius*radius
+            for p in self.game.playerGrid.query(x, y, radius):
+                if p is not bot and not p.dead:
+                    dist = (p.pos.x - x)**2 + (p.pos.y - y)**2
+                    if dist <= targetDist:
+                        target = p
+                        targetDist = dist
+            if target != None or radius >= self.sightRange:
+                return target
+            radius *= 2
+
+    # A walkable cell center within reach of the NavField around bot
+    def getWanderGoal(self, bot):
+        gameMap = self.game.gameMap
+        gs = gameMap.gridSize
+        reach = gameMap.getNavField().radius // 2
+        i = int(bot.pos.x // gs)
+        j = int(bot.pos.y // gs)
+        for attempt in range(10):
+            gi = min(max(i + self.rng.randint(-reach, reach), 0), gameMap.width - 1)
+            gj = min(max(j + self.rng.randint(-reach, reach), 0), gameMap.height - 1)
+            if gameMap.isWalkable(gi, gj):
+                break
+        return (gi*gs + gs/2, gj*gs + gs/2)
+
+    # The furthest cell center on the path to the goal the bot can walk to
+    # in a straight line, the goal itself when it is in the same cell, None
+    # when the goal can not be reached
+    def getWaypoint(self, bot, goalX, goalY):
+        gameMap = self.game.gameMap
+        navField = gameMap.getNavField()
+        gs = gameMap.gridSize
+        path = navField.getPath(int(goalX // gs), int(goalY // gs), int(bot.pos.x // gs), int(bot.pos.y // gs), self.lookahead)
+        if not path:
+            if int(goalX // gs) == int(bot.pos.x // gs) and int(goalY // gs) == int(bot.pos.y // gs):
+                return (goalX, goalY)
+            return None
+        for i, j in reversed(path[1:]):
+            cx = i*gs + gs/2
+            cy = j*gs + gs/2
+            if gameMap.sweep(bot.pos.x, bot.pos.y, cx, cy, bot.width) == None:
+                return (cx, cy)
+        i, j = path[0]
+        return (i*gs + gs/2, j*gs + gs/2)
+
+    def getInfo(self):
+        ret = {}
+        ret['decisions'] = self.decisions
+        ret.update(self.game.gameMap.getNavField().getInfo())
+        return ret
+
+class Game:
+    def __init__(self, redisConn = None, vectorBullets = VECTOR_BULLETS, deltaBroadcast = DELTA_BROADCAST, viewRadius = VIEW_RADIUS, seed = None,
+            framePerSec = FRAME_PER_SEC, sweptCollision = SWEPT_COLLISION, mapPath = MAP_PATH):
         self.gridSize = GRID_SIZE
-        self.redisConn = RedisConn()
-        self.framePerSec = 60
+        self.redisConn = redisConn if redisConn != None else createTransport(TRANSPORT)
+        # Every random choice of the game comes from here, so a seeded game
+        # with the same actions plays the same
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.framePerSec = framePerSec
         self.broadcastFreq = 20
-        self.gameMap = Map(height = self.height, width = self.width)
-        self.gameMap.loadJson('./map.json')
+        # When nothing moves and no action came in for idleDelay seconds,
+        # frames are run idleFramePerSec times a second and broadcast
+        # idleBroadcastFreq times. None keeps the full rate all the time
+        self.idleFramePerSec = 5
+        self.idleBroadcastFreq = 1
+        self.idleDelay = 2
+        self.lastActiveTime = 0
+        self.frameStep = 1
+        # Test bullets along the path they moved in a frame instead of only
+        # at where they end up
+        self.sweptCollision = sweptCollision
+        self.deltaEncoder = DeltaEncoder(keyframeInterval = self.broadcastFreq) if deltaBroadcast else None
+        # With viewRadius, every player gets its own view on view:<channel>.
+        # The global snapshot can then be turned off with globalBroadcast
+        self.viewRadius = viewRadius
+        self.globalBroadcast = True
+        self.mapPath = mapPath
+        self.gameMap = Map(fileName = mapPath)
+        self.width = self.gameMap.width
+        self.height = self.gameMap.height
         self.currFrame = 0
         self.startTime = 0
         self.players = []
+        self.registry = EntityRegistry()
+        self.playerGrid = SpatialHash(self.gridSize)
         self.playerId = 1
         self.bullets = []
+        self.bulletStore = None
+        if vectorBullets:
+            if np != None:
+                self.bulletStore = BulletStore(seed = seed)
+            else:
+                print("NumPy is not installed, use python bullets")
         self.bulletId = 1
+        self.bulletPool = ObjectPool(Bullet)
         self.items = []
+        self.itemPool = ObjectPool(Item)
         self.itemId = 1
         self.eventQueue = []
+        # At most this many frames are run in one tick, the rest are
+        # dropped or merged into one frame depending on catchUpPolicy
+        self.maxCatchUpFrames = 5
+        self.catchUpPolicy = 'drop'
+        # A merged frame is at most this many frames long and the rest are
+        # dropped, so the fastest bullet still moves less than a tile per
+        # frame at 60 frames per second
+        self.maxMergeSteps = 8
+        self.actionIngest = ActionIngest()
+        self.frameStats = FrameStats()
+        self.statsInterval = 10
+        self.lastStatsTime = time.time()
+        self.lastStats = None
+        # Seconds between snapshots written for crash recovery, None for never
+        self.snapshotInterval = 5
+        self.lastSnapshotTime = time.time()
+        # ActionLog that records the actions and frame steps of this game
+        self.recorder = None
+        self.bots = BotController(self, seed = seed)
+        # Buff expiry, respawns and item lifetimes, in game time
+        self.timers = TimerWheel()
+        self.featureLifetime = 60
+        self.itemLifetime = 60
+        # Longest name and channel, in characters, a join is accepted with
+        self.maxNameLength = 64
+        self.maxChannelLength = 256
 
     def addPlayer(self, p):
         self.players.append(p)
+        self.registry.addPlayer(p)
+        self.playerGrid.insert(p)
+
+    def removePlayer(self, p):
+        self.players.remove(p)
+        self.registry.removePlayer(p)
+        self.playerGrid.remove(p)
 
     def addBullet(self, b):
-        self.bullets.append(b)
+        if self.bulletStore != None:
+            # The store copies what it needs, the object can be reused
+            self.bulletStore.add(b)
+            self.bulletPool.put(b)
+        else:
+            self.bullets.append(b)
+            self.registry.addBullet(b)
+
+    def getBulletCount(self):
+        if self.bulletStore != None:
+            return len(self.bulletStore)
+        return len(self.bullets)
 
     def joinGame(self, channel, name):
         p = self.getPlayerByChannel(channel)
-        x, y = self.gameMap.getRandomWalkableCoord()
+        x, y = self.gameMap.getRandomWalkableCoord(self.rng)
         if p:
             if p.dead:
                 p.reborn(Point(x,y))
+                self.playerGrid.update(p)
             return p.id
         p = Player()
         p.setPos(x, y)
@@ -508,26 +1844,55 @@ class Game:
         p.channel = channel
         p.id = self.playerId
         p.name = name
-        p.lastAction = time.time()
+        p.lastAction = self.currFrame / self.framePerSec
         self.playerId += 1
         self.addPlayer(p)
         return p.id
 
     def getPlayerById(self, id):
-        for p in self.players:
-            if p.id == id:
-                return p
-        return None
-    
+        if not EntityRegistry.isKey(id):
+            return None
+        return self.registry.players.get(id)
+
     def getPlayerByChannel(self, channel):
-        for p in self.players:
-            if p.channel == channel:
-                return p
-        return None
+        if not EntityRegistry.isKey(channel):
+            return None
+        return self.registry.channels.get(channel)
+
+    # Bullets in the NumPy store have no objects, so this returns their info
+    # Bullet info of id on both engines, NumPy bullets have no objects
+    def getBulletInfoById(self, id):
+        if not EntityRegistry.isKey(id):
+            return None
+        if self.bulletStore != None:
+            return self.bulletStore.getInfoById(id)
+        b = self.registry.bullets.get(id)
+        return b.getInfo() if b != None else None
+
+    def getItemById(self, id):
+        if not EntityRegistry.isKey(id):
+            return None
+        return self.registry.items.get(id)
+
+    # Players whose center is close enough to pos that an object of
+    # size radius could touch them, in the same order as self.players
+    def getPlayersNear(self, pos, radius):
+        players = self.playerGrid.query(pos.x, pos.y, radius)
+        if len(players) > 1:
+            players.sort(key = lambda p: p.id)
+        return players
+
+    # Players that could be within radius of the segment, same order as above
+    def getPlayersNearSegment(self, x0, y0, x1, y1, radius):
+        reach = ((x1 - x0)**2 + (y1 - y0)**2)**0.5 / 2
+        players = self.playerGrid.query((x0 + x1) / 2, (y0 + y1) / 2, radius + reach)
+        if len(players) > 1:
+            players.sort(key = lambda p: p.id)
+        return players
 
     def newBullet(self, pos, speed, angle, player):
         if player != None and not player.dead:
-            bullet = Bullet()
+            bullet = self.bulletPool.get()
             bullet.setPos(pos)
             bullet.setSpeed(speed)
             bullet.setAngle(angle)
@@ -536,43 +1901,114 @@ class Game:
             self.bulletId += 1
             self.addBullet(bullet)
 
-    def updatePlayers(self):
+    def updatePlayers(self, dt):
         for player in self.players:
             if not player.dead:
-                player.move(1.0/self.framePerSec, self.gameMap)
-            else:
-                if self.currFrame - player.deadFrame > self.framePerSec:
-                    x, y = self.gameMap.getRandomWalkableCoord()
-                    player.reborn(Point(x, y))
+                player.move(dt, self.gameMap)
+                self.playerGrid.update(player)
 
-    def updateBullets(self):
-        newBullets = []
-        for bullet in self.bullets:
-            if bullet.move(1.0/self.framePerSec, self.gameMap):
-                bullet.length -= abs(bullet.speed / self.framePerSec)
+    def scheduleRespawn(self, deadFrame):
+        self.timers.schedule(deadFrame + self.framePerSec + 1, self.respawnPlayers, deadFrame)
+
+    # Players still dead since deadFrame come back, in the order of
+    # self.players whatever order they died in, so a game restored from a
+    # snapshot respawns the same. Later timers of the frame find nobody
+    def respawnPlayers(self, deadFrame):
+        for player in self.players:
+            if player.dead and player.deadFrame == deadFrame:
+                x, y = self.gameMap.getRandomWalkableCoord(self.rng)
+                player.reborn(Point(x, y))
+                self.playerGrid.update(player)
+
+    # owner is a Player or a Weapon
+    def addFeature(self, owner, feature):
+        currTime = self.currFrame / self.framePerSec
+        owner.addFeature(feature, currTime)
+        self.scheduleFeatureExpiry(owner, feature, currTime)
+
+    def scheduleFeatureExpiry(self, owner, feature, addedTime):
+        frame = int(round((addedTime + self.featureLifetime) * self.framePerSec))
+        self.timers.schedule(frame, self.expireFeature, owner, feature, addedTime)
+
+    # Unless the feature was added again since
+    def expireFeature(self, owner, feature, addedTime):
+        if owner.features.get(feature) == addedTime:
+            owner.removeFeature(feature)
+
+    def updateBullets(self, dt):
+        if self.bulletStore != None:
+            self.bulletStore.update(dt, self.gameMap, self.sweptCollision)
+            return
+        # Compact in place, a new list every frame is garbage too
+        bullets = self.bullets
+        n = 0
+        for bullet in bullets:
+            if bullet.move(dt, self.gameMap, self.rng, self.sweptCollision):
+                bullet.length -= abs(bullet.speed * dt)
                 if bullet.length > 0:
-                    newBullets.append(bullet)
-        self.bullets = newBullets
+                    bullets[n] = bullet
+                    n += 1
+                    continue
+            elif self.sweptCollision:
+                # Stopped by a wall, checkHit still tests the way there
+                bullet.length = 0
+                bullets[n] = bullet
+                n += 1
+                continue
+            self.registry.removeBullet(bullet)
+            self.bulletPool.put(bullet)
+        del bullets[n:]
 
     def generateItem(self, pos = None, itemType = None):
         if pos == None:
-            x, y = self.gameMap.getRandomWalkableCoord()
+            x, y = self.gameMap.getRandomWalkableCoord(self.rng)
         else:
             x = pos.x
             y = pos.y
-        item = Item(itemType)
+        item = self.itemPool.get(itemType, self.rng)
         item.id = self.itemId
         item.setPos(x, y)
+        item.spawnFrame = self.currFrame
         self.itemId += 1
+        self.addItem(item)
+        self.scheduleItemExpiry(item)
+
+    def scheduleItemExpiry(self, item):
+        if self.itemLifetime:
+            self.timers.schedule(item.spawnFrame + int(self.itemLifetime * self.framePerSec), self.expireItem, item, item.id)
+
+    # Items are pooled, the object may be another item by now
+    def expireItem(self, item, id):
+        if item.id == id and self.registry.items.get(id) is item:
+            self.items.remove(item)
+            self.registry.removeItem(item)
+            self.itemPool.put(item)
+
+    def addItem(self, item):
         self.items.append(item)
+        self.registry.addItem(item)
 
-    def updateFrame(self):
-        self.updatePlayers()
-        self.updateBullets()
+    # Advance the game by steps frames at once
+    def updateFrame(self, steps = 1):
+        if self.recorder != None and steps != 1:
+            self.recorder.recordSteps(self.currFrame, steps)
+        dt = steps / self.framePerSec
+        stats = self.frameStats
+        t0 = time.perf_counter()
+        self.updatePlayers(dt)
+        # Players that respawn now move from the next frame on
+        self.timers.advance(self.currFrame)
+        t1 = time.perf_counter()
+        self.updateBullets(dt)
+        t2 = time.perf_counter()
         self.checkHit()
-        if len(self.items) < 5 + 2*len(self.players) and random.uniform(0, 1) < (1/20 + 1/100*len(self.players))/ self.framePerSec:
+        t3 = time.perf_counter()
+        stats.add('updatePlayers', t1 - t0)
+        stats.add('updateBullets', t2 - t1)
+        stats.add('checkHit', t3 - t2)
+        if len(self.items) < 5 + 2*len(self.players) and self.rng.uniform(0, 1) < (1/20 + 1/100*len(self.players)) * dt:
             self.generateItem()
-        self.currFrame += 1
+        self.currFrame += steps
 
     def getDynamicGameInfo(self):
         info = {}
@@ -582,6 +2018,8 @@ class Game:
         itemInfo   = []
         for player in self.players:
             playerInfo.append(player.getInfo())
+        if self.bulletStore != None:
+            bulletInfo = self.bulletStore.getInfo()
         for bullet in self.bullets:
             bulletInfo.append(bullet.getInfo())
         for item in self.items:
@@ -593,6 +2031,105 @@ class Game:
 
         return info
 
+    def broadcast(self):
+        if self.viewRadius != None:
+            self.broadcastViews()
+            if not self.globalBroadcast:
+                return
+        info = self.getDynamicGameInfo()
+        if self.deltaEncoder != None:
+            delta = self.deltaEncoder.encode(info)
+            self.redisConn.publishDelta(delta)
+            # The key always holds the latest keyframe for new clients
+            if delta['keyframe']:
+                info['seq'] = delta['seq']
+                self.redisConn.setDynamicGameInfo(info)
+        else:
+            self.redisConn.setDynamicGameInfo(info)
+
+    # (x, y, info) of objects bucketed by cells as large as the view
+    # radius, so a view only looks at the 3x3 cells around its player
+    @staticmethod
+    def getViewCells(objs, cellSize):
+        cells = {}
+        for obj in objs:
+            x = obj.pos.x
+            y = obj.pos.y
+            key = (int(x // cellSize), int(y // cellSize))
+            bucket = cells.get(key)
+            if bucket == None:
+                cells[key] = [(x, y, obj.getInfo())]
+            else:
+                bucket.append((x, y, obj.getInfo()))
+        return cells
+
+    # Info of the entities in cells whose center is within radius of (x, y)
+    @staticmethod
+    def getNearInfo(cells, x, y, radius):
+        ret = []
+        ci = int(x // radius)
+        cj = int(y // radius)
+        r2 = radius * radius
+        for i in (ci - 1, ci, ci + 1):
+            for j in (cj - 1, cj, cj + 1):
+                bucket = cells.get((i, j))
+                if bucket != None:
+                    ret += [info for ox, oy, info in bucket if (ox - x)*(ox - x) + (oy - y)*(oy - y) <= r2]
+        return ret
+
+    # Indices of the NumPy store bullets by view cell
+    @staticmethod
+    def getStoreViewCells(bx, by, cellSize):
+        cells = {}
+        keys = zip((bx // cellSize).astype(np.int64).tolist(), (by // cellSize).astype(np.int64).tolist())
+        for i, key in enumerate(keys):
+            bucket = cells.get(key)
+            if bucket == None:
+                cells[key] = [i]
+            else:
+                bucket.append(i)
+        return {key: np.array(bucket) for key, bucket in cells.items()}
+
+    def broadcastViews(self):
+        radius = self.viewRadius
+        playerCells = self.getViewCells(self.players, radius)
+        itemCells = self.getViewCells(self.items, radius)
+        if self.bulletStore != None:
+            n = len(self.bulletStore)
+            bx = self.bulletStore.x[:n]
+            by = self.bulletStore.y[:n]
+            storeCells = self.getStoreViewCells(bx, by, radius)
+            storeInfo = None
+        else:
+            bulletCells = self.getViewCells(self.bullets, radius)
+        timestamp = self.currFrame / self.framePerSec
+        for p in self.players:
+            if p.channel == None:
+                continue
+            x = p.pos.x
+            y = p.pos.y
+            info = {}
+            info['infoType'] = 'viewInfo'
+            info['player'] = p.id
+            info['players'] = self.getNearInfo(playerCells, x, y, radius)
+            if self.bulletStore != None:
+                ci = int(x // radius)
+                cj = int(y // radius)
+                idx = [storeCells[(i, j)] for i in (ci - 1, ci, ci + 1) for j in (cj - 1, cj, cj + 1) if (i, j) in storeCells]
+                info['bullets'] = []
+                if idx:
+                    idx = np.concatenate(idx)
+                    near = idx[(bx[idx] - x)**2 + (by[idx] - y)**2 <= radius*radius]
+                    if len(near) > 0:
+                        if storeInfo == None:
+                            storeInfo = self.bulletStore.getInfo()
+                        info['bullets'] = [storeInfo[i] for i in near.tolist()]
+            else:
+                info['bullets'] = self.getNearInfo(bulletCells, x, y, radius)
+            info['items'] = self.getNearInfo(itemCells, x, y, radius)
+            info['timestamp'] = timestamp
+            self.redisConn.publishView(p.channel, info)
+
     def getStaticMapInfo(self):
         info = {}
         info['infoType'] = 'staticMapInfo'
@@ -602,13 +2139,15 @@ class Game:
 
     # Parse Actions
     def doActions(self, actions):
+        if self.recorder != None and actions:
+            self.recorder.recordActions(self.currFrame, actions)
         for action in actions:
             actionType = action['actionType']
             if actionType == 'move':
                 if 'player' in action:
                     player = self.getPlayerById(action['player'])
                     if player and not player.dead:
-                        player.lastAction = time.time()
+                        player.lastAction = self.currFrame / self.framePerSec
                         speed = player.moveSpeed-player.weapon.weight
                         if player.hasFeature("acceleration"):
                             player.setMove(action['x'], action['y'], speed*2)
@@ -620,18 +2159,28 @@ class Game:
             elif actionType == 'join':
                 self.actionJoin(action)
 
+            elif actionType == 'addBot':
+                self.addBot(action.get('name', 'bot'))
+
+            elif actionType == 'removeBot':
+                self.actionRemoveBot(action)
+
             elif actionType == 'leave':
                 pass
                 #self.actionLeave(action)
+
+            elif actionType == 'keyframe':
+                if self.deltaEncoder != None:
+                    self.deltaEncoder.requestKeyframe()
     
     @actionRequire("player", "x", "y")
     def actionShoot(self, action):
         player = self.getPlayerById(action['player'])
         if player and not player.dead:
-            player.lastAction = time.time()
-            angle = player.pos.getAngle(Point(action['x'], action['y']))
+            player.lastAction = self.currFrame / self.framePerSec
+            angle = math.atan2(action['y'] - player.pos.y, action['x'] - player.pos.x)
             pos = player.pos.getShift(angle, player.width)
-            bList = player.weapon.fire(pos = pos, angle = angle, player = player, id = self.bulletId, currTime = self.currFrame / self.framePerSec)
+            bList = player.weapon.fire(pos = pos, angle = angle, player = player, id = self.bulletId, currTime = self.currFrame / self.framePerSec, rng = self.rng, pool = self.bulletPool)
             if bList != None:
                 for b in bList:
                     player.setSpeed(0)
@@ -642,131 +2191,2012 @@ class Game:
     @actionRequire("channel", "name")
     def actionJoin(self, action):
         channel = action['channel']
-        id = self.joinGame(action['channel'], action['name'])
+        name = action['name']
+        if type(channel) != str or len(channel) > self.maxChannelLength or type(name) != str \
+                or len(name) > self.maxNameLength or type(action.get('format', '')) != str:
+            print("Error on input, bad channel, name or format {}".format(action))
+            return
+        if 'format' in action:
+            self.redisConn.useFormat(action['format'])
+        id = self.joinGame(channel, name)
         self.redisConn.publishJoin(channel, id)
 
+    @actionRequire("player")
+    def actionRemoveBot(self, action):
+        p = self.getPlayerById(action['player'])
+        if p and p.channel == None:
+            self.removePlayer(p)
+
+    # A player without a channel, driven by BotController
+    def addBot(self, name):
+        return self.joinGame(None, name)
+
     @actionRequire("channel")
     def actionLeave(self, action):
-        channel = action['channel']
-        for i in range(len(self.players)):
-            if self.players[i].channel == channel:
-                print("Player Leave", self.players[i])
-                self.players.pop(i)
-                break
+        p = self.getPlayerByChannel(action['channel'])
+        if p:
+            print("Player Leave", p)
+            self.removePlayer(p)
+
+    def hitPlayer(self, p, damage, attacker):
+        if p.hasFeature("defense"):
+            p.hp -= damage / 2
+        else:
+            p.hp -= damage
+        p.setDirty()
+        self.eventQueue.append({'eventType':'bulletHit', 'player':p.id})
+        if p.hp <= 0 and p.dead == False:
+            atkPlayer = self.getPlayerById(attacker)
+            if atkPlayer:
+                atkPlayer.kill += 1
+                atkPlayer.setDirty()
+            p.dead = True
+            p.deadFrame = self.currFrame
+            p.death += 1
+            self.scheduleRespawn(p.deadFrame)
+            self.generateItem(pos = p.pos, itemType = self.rng.choices(['random_weapon_buff', 'random_player_buff'], weights = [70, 30])[0])
+
+    def checkStoreHit(self):
+        store = self.bulletStore
+        players = [p for p in self.players if not p.dead]
+        alive = np.ones(len(store), dtype = bool)
+        for bIdx, pIdx in store.getHitPairs(players, self.sweptCollision, self.playerGrid.cellSize):
+            p = players[pIdx]
+            # Could be killed by a previous bullet in this frame
+            if not p.dead:
+                self.hitPlayer(p, int(store.damage[bIdx]), int(store.player[bIdx]))
+                alive[bIdx] = False
+        # Bullets stopped by walls in a swept update are done now
+        alive &= store.length[:len(store)] > 0
+        store.compact(alive)
 
     def checkHit(self):
-        newBullets = []
-        newPlayers = []
-        newItems   = []
-        for b in self.bullets:
+        if self.bulletStore != None:
+            self.checkStoreHit()
+        bullets = self.bullets
+        n = 0
+        for b in bullets:
             bulletHit = False
-            for p in self.players:
-                if not p.dead and b.player != p.id and p.pos.getDist(b.pos) < p.width + b.width:
-                    if p.hasFeature("defense"):
-                        p.hp -= b.damage / 2
-                    else:
-                        p.hp -= b.damage
-                    bulletHit = True
-                    self.eventQueue.append({'eventType':'bulletHit', 'player':p.id})
-                    if p.hp <= 0 and p.dead == False:
-                        atkPlayer = self.getPlayerById(b.player)
-                        if atkPlayer:
-                            atkPlayer.kill += 1
-                        p.dead = True
-                        p.deadFrame = self.currFrame
-                        p.death += 1
-                        self.generateItem(pos = p.pos, itemType = random.choices(['random_weapon_buff', 'random_player_buff'], weights = [70, 30])[0])
-                        
-            if not bulletHit:
-                newBullets.append(b)
+            if self.sweptCollision:
+                x0 = b.lastX
+                y0 = b.lastY
+                x1 = b.pos.x
+                y1 = b.pos.y
+                for p in self.getPlayersNearSegment(x0, y0, x1, y1, b.width):
+                    if not p.dead and b.player != p.id and segmentDist(p.pos.x, p.pos.y, x0, y0, x1, y1) < p.width + b.width:
+                        self.hitPlayer(p, b.damage, b.player)
+                        bulletHit = True
+            else:
+                for p in self.getPlayersNear(b.pos, b.width):
+                    if not p.dead and b.player != p.id and p.pos.getDist(b.pos) < p.width + b.width:
+                        self.hitPlayer(p, b.damage, b.player)
+                        bulletHit = True
+            if not bulletHit and b.length > 0:
+                bullets[n] = b
+                n += 1
+            else:
+                self.registry.removeBullet(b)
+                self.bulletPool.put(b)
+        del bullets[n:]
 
         # Check for items
-        for item in self.items:
+        items = self.items
+        n = 0
+        for item in items:
             itemHit = False
-            for p in self.players:
+            for p in self.getPlayersNear(item.pos, 0):
                 if not p.dead and p.pos.getDist(item.pos) < p.width:
-                    item.buff(p)
+                    item.buff(p, self)
                     itemHit = True
             if not itemHit:
-                newItems.append(item)
+                items[n] = item
+                n += 1
+            else:
+                self.registry.removeItem(item)
+                self.itemPool.put(item)
+        del items[n:]
 
-        # Get rid of inactive players
-        for p in self.players:
-            if p.lastAction >= time.time() - 120:
-                newPlayers.append(p)
+        # Get rid of inactive players, by game time so replays match
+        players = self.players
+        n = 0
+        for p in players:
+            if p.lastAction >= self.currFrame / self.framePerSec - 120:
+                players[n] = p
+                n += 1
             else:
+                self.registry.removePlayer(p)
+                self.playerGrid.remove(p)
                 print("Inactive player", p.getInfo())
+        del players[n:]
+
+    # Number of frames run together at currTime, 1 unless the room is idle
+    def getFrameStep(self, currTime):
+        if self.idleFramePerSec == None:
+            return 1
+        if self.getBulletCount() > 0 or any(p.speed != 0 for p in self.players if not p.dead):
+            self.lastActiveTime = currTime
+        if currTime - self.lastActiveTime < self.idleDelay:
+            return 1
+        return max(1, int(self.framePerSec / self.idleFramePerSec))
 
-        self.players = newPlayers
-        self.bullets = newBullets
-        self.items   = newItems
+    # Time when the next tick has frames to run, if no action comes first
+    def getNextTickTime(self):
+        return self.startTime + (self.currFrame + self.frameStep - 1) / self.framePerSec
+
+    def runFrame(self, steps = 1):
+        frameStart = time.perf_counter()
+        lastFrame = self.currFrame
+        self.updateFrame(steps)
+
+        broadcastFreq = self.broadcastFreq if self.frameStep == 1 else self.idleBroadcastFreq
+        broadcastGap = max(1, int(self.framePerSec / broadcastFreq))
+        if self.currFrame // broadcastGap != lastFrame // broadcastGap:
+            t = time.perf_counter()
+            self.broadcast()
+            self.frameStats.add('broadcast', time.perf_counter() - t)
+        self.frameStats.add('frame', time.perf_counter() - frameStart)
+
+    # Run all frames that are due at currTime, then handle actions and events
+    def tick(self, currTime):
+        frameTime = 1 / self.framePerSec
+        batches = self.redisConn.getActionBatches()
+        if batches:
+            self.lastActiveTime = currTime
+        wasIdle = self.frameStep > 1
+        self.frameStep = self.getFrameStep(currTime)
+        due = math.ceil((currTime - self.startTime) / frameTime) - self.currFrame
+        if self.frameStep > 1 or wasIdle:
+            # Idle, the due frames are run as one once there are enough of
+            # them, or right away when the room wakes up. Nothing moves, so
+            # a long frame plays the same
+            if due >= self.frameStep:
+                maxDue = self.maxCatchUpFrames * self.frameStep
+                if due > maxDue:
+                    self.startTime += (due - maxDue) * frameTime
+                    self.frameStats.droppedFrames += due - maxDue
+                    due = maxDue
+                self.runFrame(steps = due)
+            due = 0
+        # After a stall, do not try to run every missed frame or we fall
+        # further behind. Either forget the extra time, or run it as one
+        # long frame of at most maxMergeSteps
+        if due > self.maxCatchUpFrames:
+            if self.catchUpPolicy == 'merge':
+                for i in range(self.maxCatchUpFrames - 1):
+                    self.runFrame()
+                steps = due - self.maxCatchUpFrames + 1
+                merged = min(steps, self.maxMergeSteps)
+                self.startTime += (steps - merged) * frameTime
+                self.frameStats.droppedFrames += steps - merged
+                self.frameStats.mergedFrames += merged - 1
+                self.runFrame(steps = merged)
+                due = 0
+            else:
+                self.startTime += (due - self.maxCatchUpFrames) * frameTime
+                self.frameStats.droppedFrames += due - self.maxCatchUpFrames
+                due = self.maxCatchUpFrames
+        for i in range(due):
+            self.runFrame()
+
+        t = time.perf_counter()
+        actions = self.actionIngest.process(batches, currTime)
+        self.doActions(actions)
+        self.frameStats.add('doActions', time.perf_counter() - t)
+        self.updateBots()
+
+        if len(self.eventQueue) > 0:
+            self.redisConn.publishEvent(self.eventQueue)
+            self.eventQueue = []
+
+        if self.statsInterval and currTime - self.lastStatsTime > self.statsInterval:
+            self.lastStatsTime = currTime
+            self.lastStats = self.frameStats.getInfo()
+            self.lastStats['players'] = len(self.players)
+            self.lastStats['bullets'] = self.getBulletCount()
+            self.lastStats['writes'] = self.redisConn.getWriteInfo()
+            self.lastStats['actions'] = self.actionIngest.getInfo()
+            self.frameStats.reset()
+            self.redisConn.setStats(self.lastStats)
+
+        if self.snapshotInterval and currTime - self.lastSnapshotTime > self.snapshotInterval:
+            self.lastSnapshotTime = currTime
+            # A room that can not be snapshot keeps running, and so do the
+            # other rooms of its RoomManager
+            try:
+                self.redisConn.setSnapshot(GameSnapshot.pack(self))
+            except Exception as e:
+                print("Error on snapshot", e)
+
+        self.redisConn.flush()
 
     def run(self):
         self.startTime = time.time()
-        frameCount = 0
-        frameTime = 0
         while True:
-            currTime = time.time()
-            while currTime > self.startTime + self.currFrame*(1/self.framePerSec):
-                self.updateFrame()
-
-                if self.currFrame % max(1, int(self.framePerSec / self.broadcastFreq)) == 0:
-                    self.redisConn.setDynamicGameInfo(self.getDynamicGameInfo())
-                frameCount += 1
-            frameTime += time.time() - currTime
-            if frameCount > 200:
-                #print("frame time is {}, max fps is {}", frameTime / frameCount, frameCount / frameTime)
-                frameCount = 0
-                frameTime = 0
+            self.tick(time.time())
+            self.redisConn.waitForActions(self.getNextTickTime() - time.time())
 
-            
+    # run on an asyncio loop, for transports like AsyncRedisConn that wait
+    # for actions in waitForActionsAsync
+    async def runAsync(self):
+        await self.redisConn.connect()
+        self.startTime = time.time()
+        while True:
+            self.tick(time.time())
+            await self.redisConn.waitForActionsAsync(self.getNextTickTime() - time.time())
 
-            actions = self.redisConn.getActions()
+    # Run one frame and then the given actions and the ones in redisConn,
+    # without looking at the clock. Used to run games headless
+    def step(self, actions = None):
+        self.runFrame()
+        t = time.perf_counter()
+        if actions:
             self.doActions(actions)
-            
-            if len(self.eventQueue) > 0:
-                self.redisConn.publishEvent(self.eventQueue)
-                self.eventQueue = []
+        self.doActions(self.actionIngest.process(self.redisConn.getActionBatches(), self.currFrame / self.framePerSec))
+        self.frameStats.add('doActions', time.perf_counter() - t)
+        self.updateBots()
+        if len(self.eventQueue) > 0:
+            self.redisConn.publishEvent(self.eventQueue)
+            self.eventQueue = []
+
+    # Not part of updateFrame, so a replay only plays the recorded actions
+    def updateBots(self):
+        t = time.perf_counter()
+        self.doActions(self.bots.update())
+        self.frameStats.add('bots', time.perf_counter() - t)
 
-            gevent.sleep(0.005)
+    def runHeadless(self, frames):
+        for i in range(frames):
+            self.step()
 
+# Histogram with exponential buckets, so percentiles of a phase over many
+# frames are kept in a few ints. Percentiles are the bucket upper bound
+class Histogram:
+    base = 1.2
+    minValue = 1e-6
 
-class RedisConn:
     def __init__(self):
-        self.actionQueue = gevent.queue.Queue()
-        self.pubsub = redisConn.pubsub()
-        self.pubsub.subscribe('actions')
-        self.actionLoader = gevent.spawn(self.runActionQueue)
-        gevent.sleep(0)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
 
-    def runActionQueue(self):
+    def add(self, value):
+        if value <= self.minValue:
+            idx = 0
+        else:
+            idx = int(math.log(value / self.minValue, self.base)) + 1
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def getPercentile(self, p):
+        target = p * self.count
+        acc = 0
+        for idx in sorted(self.buckets):
+            acc += self.buckets[idx]
+            if acc >= target:
+                return min(self.max, self.minValue * self.base ** idx)
+        return self.max
+
+    def getInfo(self):
+        ret = {}
+        ret['count'] = self.count
+        ret['avg'] = self.total / self.count if self.count else 0
+        ret['p50'] = self.getPercentile(0.5)
+        ret['p99'] = self.getPercentile(0.99)
+        ret['max'] = self.max
+        return ret
+
+# Time spent per phase of the game loop, in seconds
+class FrameStats:
+    phases = ['updatePlayers', 'updateBullets', 'checkHit', 'broadcast', 'doActions', 'bots', 'frame']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.histograms = {phase: Histogram() for phase in self.phases}
+        self.droppedFrames = 0
+        self.mergedFrames = 0
+
+    def add(self, phase, t):
+        self.histograms[phase].add(t)
+
+    def getInfo(self):
+        ret = {}
+        ret['frames'] = self.histograms['frame'].count
+        ret['droppedFrames'] = self.droppedFrames
+        ret['mergedFrames'] = self.mergedFrames
+        for phase, histogram in self.histograms.items():
+            ret[phase] = histogram.getInfo()
+        return ret
+
+# Hosts many games in one process. All rooms share one pubsub connection
+# and are driven by one scheduler loop, each room reads and writes keys and
+# channels prefixed with its name
+class RoomManager:
+    def __init__(self, reportInterval = 10):
+        self.rooms = {}
+        self.channelHandlers = {}
+        self.writeBuffer = WriteBuffer()
+        self.pubsub = getRedis().pubsub()
+        self.listener = None
+        # Set on every message, so run can sleep until a room is due
+        self.wakeup = gevent.event.Event()
+        self.reportInterval = reportInterval
+        self.lastReport = time.time()
+
+    def subscribe(self, channels, handler):
+        for channel in channels:
+            if type(channel) == str:
+                channel = channel.encode('utf-8')
+            self.channelHandlers[channel] = handler
+            self.pubsub.subscribe(channel)
+        if self.listener == None or self.listener.dead:
+            self.listener = gevent.spawn(self.runListener)
+
+    def unsubscribe(self, channels):
+        for channel in channels:
+            if type(channel) == str:
+                channel = channel.encode('utf-8')
+            self.channelHandlers.pop(channel, None)
+            self.pubsub.unsubscribe(channel)
+
+    def addRoom(self, name):
+        if name in self.rooms:
+            return self.rooms[name]
+        conn = RedisConn(namespace = name, listen = False, writeBuffer = self.writeBuffer)
+        game = Game(redisConn = conn)
+        # Carry on from the snapshot of a room that crashed or was moved
+        snapshot = conn.getSnapshot()
+        if snapshot != None:
+            try:
+                GameSnapshot.loads(snapshot, game)
+            except (ValueError, struct.error, zlib.error) as e:
+                print("Bad snapshot for room", name, e)
+                game = Game(redisConn = conn)
+        game.startTime = time.time() - game.currFrame / game.framePerSec
+        if REPLAY_DIR:
+            game.recorder = ActionLog(os.path.join(REPLAY_DIR, '{}-{}.bfr'.format(name, int(time.time()))), game)
+        self.rooms[name] = game
+        self.subscribe(conn.actionChannels, conn.onMessage)
+        return game
+
+    def removeRoom(self, name):
+        game = self.rooms.pop(name, None)
+        if game != None:
+            self.unsubscribe(game.redisConn.actionChannels)
+            game.redisConn.deleteSnapshot()
+            if game.recorder != None:
+                game.recorder.close()
+        return game
+
+    # Stop running a room and leave its state in redis, so addRoom in
+    # another process continues the match
+    def releaseRoom(self, name):
+        game = self.rooms.pop(name, None)
+        if game != None:
+            self.unsubscribe(game.redisConn.actionChannels)
+            try:
+                game.redisConn.saveSnapshot(GameSnapshot.pack(game))
+            except Exception as e:
+                print("Error on snapshot of room", name, e)
+            if game.recorder != None:
+                game.recorder.close()
+        return game
+
+    def getPlayerCount(self):
+        return sum(len(game.players) for game in self.rooms.values())
+
+    def runListener(self):
         for message in self.pubsub.listen():
-            data = message.get('data')
             if message['type'] == 'message':
-                dataStr = data.decode('utf-8')
-                print(dataStr)
-                lst = json.loads(dataStr)
-                for r in lst:
-                    self.actionQueue.put(r)
+                handler = self.channelHandlers.get(message['channel'])
+                if handler != None:
+                    # One bad message must not stop the listener, every
+                    # room of the process gets its actions through it
+                    try:
+                        handler(message)
+                    except Exception as e:
+                        print("Error on message", message['channel'], e)
+                    self.wakeup.set()
+
+    def report(self):
+        stats = {}
+        for name, game in self.rooms.items():
+            if game.lastStats != None:
+                stats[name] = json.dumps(game.lastStats)
+        if stats:
+            self.writeBuffer.hset('roomStats', stats)
+
+    def tick(self, currTime):
+        for game in list(self.rooms.values()):
+            game.tick(currTime)
+        if currTime - self.lastReport > self.reportInterval:
+            self.lastReport = currTime
+            self.report()
+            self.writeBuffer.flush()
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            self.tick(time.time())
+            wakeTime = self.lastReport + self.reportInterval
+            for game in self.rooms.values():
+                wakeTime = min(wakeTime, game.getNextTickTime())
+            self.wakeup.wait(max(0, wakeTime - time.time()))
+
+# A RoomManager run by the Supervisor in its own process. The lobby sends
+# it join requests, it places them in a room with space, creating rooms
+# as needed, and reports its load to the workerLoad hash
+class Worker(RoomManager):
+    def __init__(self, workerId, roomCapacity = 16, reportInterval = 2, joinTimeout = 10):
+        RoomManager.__init__(self, reportInterval = reportInterval)
+        self.workerId = workerId
+        self.roomCapacity = roomCapacity
+        self.joinTimeout = joinTimeout
+        self.roomIndex = 0
+        self.emptyRooms = {}
+        # room -> {channel: time} of players sent to a room but not joined yet
+        self.pendingJoins = {}
+        self.subscribe(['worker:{}:lobby'.format(workerId)], self.onLobbyMessage)
+        self.restoreRooms()
+
+    # A worker restarted by the Supervisor takes back the rooms it had,
+    # from their snapshots
+    def restoreRooms(self):
+        rooms = getRedis().hgetall('workerRooms').get(str(self.workerId).encode('utf-8'))
+        if rooms == None:
+            return
+        prefix = 'w{}r'.format(self.workerId)
+        for name in json.loads(rooms):
+            self.addRoom(name)
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                self.roomIndex = max(self.roomIndex, int(name[len(prefix):]))
+
+    def getRoomLoad(self, name):
+        game = self.rooms[name]
+        pending = self.pendingJoins.get(name, {})
+        currTime = time.time()
+        for channel in list(pending):
+            if game.getPlayerByChannel(channel) or pending[channel] < currTime - self.joinTimeout:
+                pending.pop(channel)
+        return len(game.players) + len(pending)
+
+    def getPlayerCount(self):
+        return sum(self.getRoomLoad(name) for name in self.rooms)
+
+    def getFreeRoom(self):
+        rooms = [(self.getRoomLoad(name), name) for name in self.rooms]
+        rooms = [room for room in rooms if room[0] < self.roomCapacity]
+        if rooms:
+            # Fill the fullest room first so matches are not spread thin
+            return max(rooms)[1]
+        self.roomIndex += 1
+        name = 'w{}r{}'.format(self.workerId, self.roomIndex)
+        self.addRoom(name)
+        return name
+
+    def removeRoom(self, name):
+        self.pendingJoins.pop(name, None)
+        return RoomManager.removeRoom(self, name)
+
+    def releaseRoom(self, name):
+        self.pendingJoins.pop(name, None)
+        self.emptyRooms.pop(name, None)
+        return RoomManager.releaseRoom(self, name)
+
+    def onLobbyMessage(self, message):
+        try:
+            request = json.loads(message['data'])
+        except ValueError:
+            print("Error on decoding lobby request", message['data'])
+            return
+        if type(request) != dict:
+            print("Error on lobby request", request)
+            return
+        for key in ('releaseRoom', 'adoptRoom', 'channel'):
+            if key in request and type(request[key]) != str:
+                print("Error on lobby request", request)
+                return
+        # Moving a room: release it on one worker, then adopt it on another
+        # once roomReleased is published
+        if 'releaseRoom' in request:
+            if self.releaseRoom(request['releaseRoom']) != None:
+                self.writeBuffer.publish('lobby:events', json.dumps({'infoType':'roomReleased', 'room':request['releaseRoom']}))
+                self.writeBuffer.flush()
+            return
+        if 'adoptRoom' in request:
+            self.addRoom(request['adoptRoom'])
+            return
+        if 'channel' not in request:
+            print("Error on lobby request", request)
+            return
+        room = self.getFreeRoom()
+        self.pendingJoins.setdefault(room, {})[request['channel']] = time.time()
+        # A room that just got a player should not be collected as empty
+        self.emptyRooms.pop(room, None)
+        self.writeBuffer.publish('lobby:events', json.dumps({'infoType':'roomInfo', 'channel':request['channel'], 'room':room}))
+        self.writeBuffer.flush()
+
+    def report(self):
+        # Rooms that stay empty over two reports are closed
+        for name in list(self.rooms):
+            if self.getRoomLoad(name) == 0:
+                self.emptyRooms[name] = self.emptyRooms.get(name, 0) + 1
+                if self.emptyRooms[name] >= 2:
+                    self.removeRoom(name)
+                    self.emptyRooms.pop(name)
+            else:
+                self.emptyRooms.pop(name, None)
+        RoomManager.report(self)
+        load = {'players':self.getPlayerCount(), 'rooms':len(self.rooms), 'time':time.time()}
+        self.writeBuffer.hset('workerLoad', {self.workerId: json.dumps(load)})
+        self.writeBuffer.hset('workerRooms', {self.workerId: json.dumps(sorted(self.rooms))})
+
+def runWorker(workerId):
+    monkey.patch_all()
+    Worker(workerId).run()
+
+# Routes join requests from the lobby channel to the worker with the
+# fewest players, based on the load workers report
+class Lobby:
+    def __init__(self, workerTimeout = 10, loadInterval = 1):
+        self.workerTimeout = workerTimeout
+        self.loadInterval = loadInterval
+        self.loads = {}
+        self.reportTime = {}
+        # worker -> times of requests routed there, until the worker reports
+        self.routed = {}
+        self.lastLoad = 0
+        self.pubsub = getRedis().pubsub()
+        self.pubsub.subscribe('lobby')
+
+    def updateLoads(self):
+        currTime = time.time()
+        if currTime - self.lastLoad < self.loadInterval:
+            return
+        self.lastLoad = currTime
+        loads = {}
+        for workerId, info in getRedis().hgetall('workerLoad').items():
+            info = json.loads(info)
+            if info['time'] > currTime - self.workerTimeout:
+                workerId = workerId.decode('utf-8')
+                loads[workerId] = info['players']
+                self.reportTime[workerId] = info['time']
+        self.loads = loads
+
+    def getLoad(self, workerId):
+        # Requests routed after the last report are not in it yet
+        reportTime = self.reportTime.get(workerId, 0)
+        routed = [t for t in self.routed.get(workerId, []) if t > reportTime]
+        self.routed[workerId] = routed
+        return self.loads[workerId] + len(routed)
+
+    def route(self, request):
+        self.updateLoads()
+        if not self.loads:
+            print("No worker for lobby request", request)
+            return None
+        workerId = min(self.loads, key = self.getLoad)
+        self.routed.setdefault(workerId, []).append(time.time())
+        getRedis().publish('worker:{}:lobby'.format(workerId), json.dumps(request))
+        return workerId
+
+    def run(self):
+        for message in self.pubsub.listen():
+            if message['type'] == 'message':
+                try:
+                    requests = json.loads(message['data'])
+                except ValueError:
+                    print("Error on decoding lobby requests", message['data'])
+                    continue
+                if type(requests) != list:
+                    requests = [requests]
+                for request in requests:
+                    if type(request) != dict or type(request.get('channel')) != str:
+                        print("Error on lobby request", request)
+                        continue
+                    self.route(request)
+
+# Starts one worker process per core, restarts the ones that die and runs
+# the lobby in the main process
+class Supervisor:
+    def __init__(self, workers = None):
+        self.workerCount = workers or multiprocessing.cpu_count()
+        self.processes = {}
+
+    def startWorker(self, workerId):
+        p = multiprocessing.Process(target = runWorker, args = (workerId,), daemon = True)
+        p.start()
+        self.processes[workerId] = p
+
+    def run(self):
+        for i in range(self.workerCount):
+            self.startWorker(str(i))
+        gevent.spawn(Lobby().run)
+        while True:
+            for workerId, p in list(self.processes.items()):
+                if not p.is_alive():
+                    print("Worker {} exited with {}, restart".format(workerId, p.exitcode))
+                    self.startWorker(workerId)
+            gevent.sleep(1)
+
+# Wire formats. Every format reads and writes the same keys and channels
+# with its own suffix, so clients pick one by the names they use
+# Encoded entity info by dict identity. Players and items that did not
+# change give the same cached dict every frame (see GameObject), so their
+# encoding is reused. Entries hold the dict, so its id can not be reused
+# by another dict while cached, and the cache is cleared when it is full
+class FragmentCache:
+    def __init__(self, maxSize = 16384):
+        self.maxSize = maxSize
+        self.fragments = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, e, encode):
+        entry = self.fragments.get(id(e))
+        if entry != None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        if len(self.fragments) >= self.maxSize:
+            self.fragments.clear()
+        fragment = encode(e)
+        self.fragments[id(e)] = (e, fragment)
+        return fragment
+
+class JsonSerializer:
+    suffix = ''
+    # Bullets move every frame, their info is never cached
+    cachedKinds = ('players', 'items')
+
+    def __init__(self):
+        self.fragments = FragmentCache()
+        # Same settings as json.dumps, without its per call overhead, which
+        # adds up over the many small values of per-player views
+        self.encode = json.JSONEncoder().encode
+        self.keys = {}
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    # Same output as dumps(info), with cached fragments for entities
+    def dumpsState(self, info):
+        parts = []
+        for key, value in info.items():
+            prefix = self.keys.get(key)
+            if prefix == None:
+                prefix = self.keys[key] = self.encode(key) + ': '
+            if key in self.cachedKinds:
+                value = '[' + ', '.join([self.fragments.get(e, self.encode) for e in value]) + ']'
+            else:
+                value = self.encode(value)
+            parts.append(prefix + value)
+        return '{' + ', '.join(parts) + '}'
+
+    def loadsState(self, data):
+        return self.loads(data)
+
+# Dynamic game info is packed into fixed-width little endian records with
+# quantized values, positions as uint16 pixels and angles as uint8. Other
+# messages use msgpack, or compact json when msgpack is not installed
+class PackedSerializer:
+    suffix = ':bin'
+    version = 1
+    weaponNames = ['base', 'german_pistol', 'mp_40', 'mp_43', 'm1_carbine', 'fg_42', 'ar']
+    itemTypes = ['health', 'german_pistol', 'mp_43', 'm1_carbine', 'mp_40', 'fg_42', 'random_weapon_buff', 'random_player_buff']
+    playerFeatures = ['defense', 'acceleration']
+    # version, timestamp, seq, player count, bullet count, item count
+    header = struct.Struct('<BfIHHH')
+    # id, x, y, angle, speed, hp, flags(bit 0 dead, then features), weapon, kill, death, name length
+    playerRecord = struct.Struct('<IHHBhhBBHHB')
+    # id, x, y, angle, speed, size
+    bulletRecord = struct.Struct('<IHHBhB')
+    # id, x, y, itemType
+    itemRecord = struct.Struct('<IHHB')
+
+    def __init__(self):
+        self.fragments = FragmentCache()
+
+    def dumps(self, obj):
+        if msgpack != None:
+            return msgpack.packb(obj, use_bin_type = True)
+        return json.dumps(obj, separators = (',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        if msgpack != None:
+            return msgpack.unpackb(data, raw = False)
+        return json.loads(data)
+
+    @staticmethod
+    def packPos(v):
+        return min(max(int(round(v)), 0), 0xffff)
+
+    @staticmethod
+    def packAngle(angle):
+        return int(round(angle / (2*math.pi) * 256)) & 0xff
+
+    @staticmethod
+    def unpackAngle(v):
+        angle = v * 2*math.pi / 256
+        return angle - 2*math.pi if angle > math.pi else angle
+
+    # (record, name) of a player
+    def packPlayer(self, p):
+        flags = 1 if p['dead'] else 0
+        for i, feature in enumerate(self.playerFeatures):
+            if feature in p['features']:
+                flags |= 2 << i
+        # Joins only take str names, but a game may be given others
+        name = str(p['name']).encode('utf-8')[:255]
+        return (self.playerRecord.pack(p['id'], self.packPos(p['x']), self.packPos(p['y']),
+                self.packAngle(p['angle']), int(p['speed']), int(round(p['hp'])), flags,
+                self.weaponNames.index(p['weapon']), p['kill'], p['death'], len(name)), name)
+
+    def packItem(self, item):
+        return self.itemRecord.pack(item['id'], self.packPos(item['x']), self.packPos(item['y']),
+                self.itemTypes.index(item['itemType']))
+
+    def dumpsState(self, info):
+        players = info['players']
+        bullets = info['bullets']
+        items = info['items']
+        parts = [self.header.pack(self.version, info['timestamp'], info.get('seq', 0), len(players), len(bullets), len(items))]
+        names = []
+        for p in players:
+            record, name = self.fragments.get(p, self.packPlayer)
+            parts.append(record)
+            names.append(name)
+        parts.extend(names)
+        for b in bullets:
+            parts.append(self.bulletRecord.pack(b['id'], self.packPos(b['x']), self.packPos(b['y']),
+                    self.packAngle(b['angle']), int(b['speed']), int(b['size'])))
+        for item in items:
+            parts.append(self.fragments.get(item, self.packItem))
+        return b''.join(parts)
+
+    def loadsState(self, data):
+        version, timestamp, seq, playerCount, bulletCount, itemCount = self.header.unpack_from(data, 0)
+        offset = self.header.size
+        info = {'infoType':'dynamicGameInfo', 'timestamp':timestamp, 'seq':seq}
+        players = []
+        nameLengths = []
+        for i in range(playerCount):
+            id, x, y, angle, speed, hp, flags, weapon, kill, death, nameLength = self.playerRecord.unpack_from(data, offset)
+            offset += self.playerRecord.size
+            nameLengths.append(nameLength)
+            players.append({'id':id, 'x':x, 'y':y, 'angle':self.unpackAngle(angle), 'speed':speed, 'hp':hp,
+                    'dead':bool(flags & 1), 'weapon':self.weaponNames[weapon], 'kill':kill, 'death':death,
+                    'features':[f for i, f in enumerate(self.playerFeatures) if flags & (2 << i)]})
+        for p, nameLength in zip(players, nameLengths):
+            p['name'] = data[offset:offset + nameLength].decode('utf-8', 'replace')
+            offset += nameLength
+        bullets = []
+        for i in range(bulletCount):
+            id, x, y, angle, speed, size = self.bulletRecord.unpack_from(data, offset)
+            offset += self.bulletRecord.size
+            bullets.append({'id':id, 'x':x, 'y':y, 'angle':self.unpackAngle(angle), 'speed':speed, 'size':size})
+        items = []
+        for i in range(itemCount):
+            id, x, y, itemType = self.itemRecord.unpack_from(data, offset)
+            offset += self.itemRecord.size
+            items.append({'id':id, 'x':x, 'y':y, 'itemType':self.itemTypes[itemType]})
+        info['players'] = players
+        info['bullets'] = bullets
+        info['items'] = items
+        return info
+
+# Full state of a Game as a versioned binary blob, so a room can be
+# restored after a crash or moved to another process. Records are little
+# endian structs like PackedSerializer but without quantizing, strings come
+# after the player records, and the body is zlib compressed. The map is
+# not included, it is loaded from mapPath, but the map path and checksum
+# are, so a snapshot is not loaded on another map
+class GameSnapshot:
+    magic = b'BFSN'
+    version = 3
+    # magic, version, body length
+    header = struct.Struct('<4sBI')
+    # map checksum, map path length
+    mapRecord = struct.Struct('<IH')
+    weaponTypes = [WeaponBase, WeaponPistol, WeaponMp40, WeaponMp43, WeaponM1, WeaponFg42, WeaponAr]
+    playerFeatures = ['defense', 'acceleration']
+    # currFrame, playerId, bulletId, itemId, player count, bullet count,
+    # item count, has seed, seed, has gauss, gauss, store rng state length
+    gameRecord = struct.Struct('<IIIIIIIBqBdH')
+    # random.Random state, 624 words and the index
+    rngRecord = struct.Struct('<625I')
+    # id, x, y, destination x, destination y, angle, speed, moveSpeed, hp,
+    # dead, deadFrame, kill, death, lastAction, weapon, weapon lastFire,
+    # weapon feature count, feature count, name length, channel length
+    playerRecord = struct.Struct('<IddddddddBIIIdBdBBHH')
+    # feature index, game time it was added
+    featureRecord = struct.Struct('<Bd')
+    # id, x, y, lastX, lastY, angle, speed, length, damage, size, player, feature bits
+    bulletRecord = struct.Struct('<IdddddddiHIB')
+    # id, x, y, itemType, spawnFrame
+    itemRecord = struct.Struct('<IddBI')
+    # bulletRecord as a NumPy dtype, so a BulletStore is copied in one go
+    bulletDtype = np.dtype([('id', '<u4'), ('x', '<f8'), ('y', '<f8'), ('lastX', '<f8'), ('lastY', '<f8'),
+            ('angle', '<f8'), ('speed', '<f8'), ('length', '<f8'), ('damage', '<i4'), ('size', '<u2'),
+            ('player', '<u4'), ('features', 'u1')]) if np != None else None
+    noChannel = 0xffff
+
+    # Doubles that were ints before packing, so restored state prints the same
+    @staticmethod
+    def number(v):
+        return int(v) if v.is_integer() else v
+
+    @classmethod
+    def pack(cls, game):
+        store = game.bulletStore
+        storeState = json.dumps(store.rng.bit_generator.state).encode('utf-8') if store != None else b''
+        rngVersion, rngState, gauss = game.rng.getstate()
+        seed = game.seed if type(game.seed) == int else None
+        mapPath = game.mapPath.encode('utf-8')
+        parts = [cls.mapRecord.pack(game.gameMap.getCrc(), len(mapPath)), mapPath,
+                cls.gameRecord.pack(game.currFrame, game.playerId, game.bulletId, game.itemId,
+                len(game.players), game.getBulletCount(), len(game.items), seed != None, seed or 0,
+                gauss != None, gauss or 0, len(storeState)),
+                cls.rngRecord.pack(*rngState), storeState]
+        strings = []
+        for p in game.players:
+            weapon = p.weapon
+            weaponFeatures = [(BULLET_FEATURES.index(f), t) for f, t in weapon.features.items() if f in BULLET_FEATURES]
+            features = [(cls.playerFeatures.index(f), t) for f, t in p.features.items() if f in cls.playerFeatures]
+            name = p.name.encode('utf-8')
+            channel = p.channel.encode('utf-8') if p.channel != None else b''
+            # noChannel marks a player without a channel
+            if len(name) > 0xffff or len(channel) >= cls.noChannel:
+                raise ValueError("Name or channel of player {} is too long for a snapshot".format(p.id))
+            strings.append(name)
+            strings.append(channel)
+            parts.append(cls.playerRecord.pack(p.id, p.pos.x, p.pos.y, p.moveDestination.x, p.moveDestination.y,
+                    p.moveAngle, p.speed, p.moveSpeed, p.hp, p.dead, p.deadFrame, p.kill, p.death, p.lastAction,
+                    cls.weaponTypes.index(type(weapon)), weapon.lastFire, len(weaponFeatures), len(features),
+                    len(name), len(channel) if p.channel != None else cls.noChannel))
+            for index, t in weaponFeatures + features:
+                parts.append(cls.featureRecord.pack(index, t))
+        parts.extend(strings)
+        if store != None:
+            n = len(store)
+            bullets = np.zeros(n, dtype = cls.bulletDtype)
+            for name in cls.bulletDtype.names:
+                bullets[name] = getattr(store, name)[:n]
+            parts.append(bullets.tobytes())
+        for b in game.bullets:
+            features = 0
+            for feature in b.features:
+                features |= BULLET_FEATURE_BITS.get(feature, 0)
+            parts.append(cls.bulletRecord.pack(b.id, b.pos.x, b.pos.y, b.lastX, b.lastY, b.moveAngle,
+                    b.speed, b.length, b.damage, b.width, b.player, features))
+        for item in game.items:
+            parts.append(cls.itemRecord.pack(item.id, item.pos.x, item.pos.y, PackedSerializer.itemTypes.index(item.itemType), item.spawnFrame))
+        return b''.join(parts)
+
+    @classmethod
+    def compress(cls, body, level = 1):
+        return cls.header.pack(cls.magic, cls.version, len(body)) + zlib.compress(body, level)
+
+    @classmethod
+    def dumps(cls, game):
+        return cls.compress(cls.pack(game))
+
+    # Load data into a Game that was just created, with no players yet
+    @classmethod
+    def loads(cls, data, game):
+        magic, version, length = cls.header.unpack_from(data, 0)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError("Unknown snapshot version {} {}".format(magic, version))
+        data = zlib.decompress(data[cls.header.size:])
+        mapCrc, mapPathLength = cls.mapRecord.unpack_from(data, 0)
+        offset = cls.mapRecord.size
+        mapPath = data[offset:offset + mapPathLength].decode('utf-8')
+        offset += mapPathLength
+        if mapCrc != game.gameMap.getCrc():
+            raise ValueError("Snapshot is of map {}, not {}".format(mapPath, game.mapPath))
+        currFrame, playerId, bulletId, itemId, playerCount, bulletCount, itemCount, hasSeed, seed, \
+                hasGauss, gauss, storeStateLength = cls.gameRecord.unpack_from(data, offset)
+        offset += cls.gameRecord.size
+        rngState = cls.rngRecord.unpack_from(data, offset)
+        offset += cls.rngRecord.size
+        game.rng.setstate((3, rngState, gauss if hasGauss else None))
+        game.seed = seed if hasSeed else None
+        if storeStateLength > 0 and game.bulletStore != None:
+            game.bulletStore.rng.bit_generator.state = json.loads(data[offset:offset + storeStateLength])
+        offset += storeStateLength
+        game.currFrame = currFrame
+        game.playerId = playerId
+        game.bulletId = bulletId
+        game.itemId = itemId
+
+        players = []
+        lengths = []
+        for i in range(playerCount):
+            id, x, y, destX, destY, angle, speed, moveSpeed, hp, dead, deadFrame, kill, death, lastAction, \
+                    weaponType, lastFire, weaponFeatureCount, featureCount, nameLength, channelLength = \
+                    cls.playerRecord.unpack_from(data, offset)
+            offset += cls.playerRecord.size
+            p = Player()
+            p.id = id
+            p.setPos(x, y)
+            p.moveDestination.set(destX, destY)
+            p.moveAngle = angle
+            p.speed = cls.number(speed)
+            p.moveSpeed = cls.number(moveSpeed)
+            p.hp = cls.number(hp)
+            p.dead = bool(dead)
+            p.deadFrame = deadFrame
+            p.kill = kill
+            p.death = death
+            p.lastAction = lastAction
+            p.weapon = cls.weaponTypes[weaponType]()
+            p.weapon.lastFire = lastFire
+            for j in range(weaponFeatureCount + featureCount):
+                index, t = cls.featureRecord.unpack_from(data, offset)
+                offset += cls.featureRecord.size
+                if j < weaponFeatureCount:
+                    p.weapon.features[BULLET_FEATURES[index]] = t
+                else:
+                    p.features[cls.playerFeatures[index]] = t
+            players.append(p)
+            lengths.append((nameLength, channelLength))
+        for p, (nameLength, channelLength) in zip(players, lengths):
+            p.name = data[offset:offset + nameLength].decode('utf-8')
+            offset += nameLength
+            if channelLength != cls.noChannel:
+                p.channel = data[offset:offset + channelLength].decode('utf-8')
+                offset += channelLength
+            game.addPlayer(p)
+
+        if game.bulletStore != None:
+            bullets = np.frombuffer(data, dtype = cls.bulletDtype, count = bulletCount, offset = offset)
+            store = game.bulletStore
+            store.reserve(bulletCount)
+            for name in cls.bulletDtype.names:
+                getattr(store, name)[:bulletCount] = bullets[name]
+            store.count = bulletCount
+            offset += bulletCount * cls.bulletRecord.size
+        else:
+            end = offset + bulletCount * cls.bulletRecord.size
+            featureSets = {}
+            for id, x, y, lastX, lastY, angle, speed, length, damage, size, player, features in \
+                    cls.bulletRecord.iter_unpack(data[offset:end]):
+                if features not in featureSets:
+                    featureSets[features] = [f for f in BULLET_FEATURES if features & BULLET_FEATURE_BITS[f]]
+                b = Bullet()
+                b.id = id
+                b.pos.set(x, y)
+                b.lastX = lastX
+                b.lastY = lastY
+                b.moveAngle = angle
+                b.speed = int(speed) if speed.is_integer() else speed
+                b.length = int(length) if length.is_integer() else length
+                b.damage = damage
+                b.width = size
+                b.height = size
+                b.player = player
+                b.features.update(featureSets[features])
+                game.addBullet(b)
+            offset = end
+
+        for i in range(itemCount):
+            id, x, y, itemType, spawnFrame = cls.itemRecord.unpack_from(data, offset)
+            offset += cls.itemRecord.size
+            item = Item(PackedSerializer.itemTypes[itemType])
+            item.id = id
+            item.setPos(x, y)
+            item.spawnFrame = spawnFrame
+            game.addItem(item)
+
+        # Timers are not in the snapshot, they follow from the state
+        game.timers = TimerWheel(currFrame)
+        for p in players:
+            for owner in (p.weapon, p):
+                for feature, addedTime in owner.features.items():
+                    game.scheduleFeatureExpiry(owner, feature, addedTime)
+            if p.dead:
+                game.scheduleRespawn(p.deadFrame)
+        for item in game.items:
+            game.scheduleItemExpiry(item)
+        return game
+
+# Append-only replay of a game. The file starts with a header and a
+# GameSnapshot of the game when recording began, which holds the seed and
+# rng state, followed by zlib compressed chunks of records. A record is the
+# actions given to doActions at a frame, or a frame step longer than one.
+# Chunk headers hold their frame range, so they are the index for seeking
+class ActionLog:
+    magic = b'BFRL'
+    version = 2
+    # magic, version, framePerSec, flags (bit 0 sweptCollision, bit 1
+    # NumPy bullets), map checksum, map path length, snapshot length. The
+    # map path follows the header
+    header = struct.Struct('<4sBHBIHI')
+    # first frame, last frame, record count, compressed length
+    chunkHeader = struct.Struct('<IIII')
+    # frame, steps (0 for actions), payload length
+    record = struct.Struct('<IHI')
+
+    def __init__(self, path, game, chunkFrames = 600):
+        self.path = path
+        self.chunkFrames = chunkFrames
+        self.file = open(path, 'wb')
+        snapshot = GameSnapshot.dumps(game)
+        flags = (1 if game.sweptCollision else 0) | (2 if game.bulletStore != None else 0)
+        mapPath = game.mapPath.encode('utf-8')
+        self.file.write(self.header.pack(self.magic, self.version, game.framePerSec, flags,
+                game.gameMap.getCrc(), len(mapPath), len(snapshot)))
+        self.file.write(mapPath)
+        self.file.write(snapshot)
+        self.file.flush()
+        self.pending = []
+        self.count = 0
+        self.firstFrame = None
+        self.lastFrame = 0
+
+    def add(self, frame, steps, payload):
+        if self.firstFrame == None:
+            self.firstFrame = frame
+        self.lastFrame = frame
+        self.pending.append(self.record.pack(frame, steps, len(payload)))
+        self.pending.append(payload)
+        self.count += 1
+        if frame - self.firstFrame >= self.chunkFrames:
+            self.flush()
+
+    def recordActions(self, frame, actions):
+        self.add(frame, 0, json.dumps(actions, separators = (',', ':')).encode('utf-8'))
+
+    def recordSteps(self, frame, steps):
+        self.add(frame, steps, b'')
+
+    def flush(self):
+        if self.count == 0:
+            return
+        data = zlib.compress(b''.join(self.pending))
+        self.file.write(self.chunkHeader.pack(self.firstFrame, self.lastFrame, self.count, len(data)))
+        self.file.write(data)
+        self.file.flush()
+        self.pending = []
+        self.count = 0
+        self.firstFrame = None
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# Reads an ActionLog and plays it again without redis, as fast as possible
+class Replay:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        magic, version, self.framePerSec, flags, self.mapCrc, mapPathLength, snapshotLength = \
+                ActionLog.header.unpack_from(self.data, 0)
+        if magic != ActionLog.magic or version != ActionLog.version:
+            raise ValueError("Unknown replay version {} {}".format(magic, version))
+        self.sweptCollision = bool(flags & 1)
+        # The two bullet engines draw different random numbers, so a replay
+        # only matches with the engine it was recorded with
+        self.vectorBullets = bool(flags & 2)
+        offset = ActionLog.header.size
+        self.mapPath = self.data[offset:offset + mapPathLength].decode('utf-8')
+        offset += mapPathLength
+        self.snapshot = self.data[offset:offset + snapshotLength]
+        offset += snapshotLength
+        # (first frame, last frame, offset, length) of every chunk. A chunk
+        # cut short by a crash is left out
+        self.chunks = []
+        while offset + ActionLog.chunkHeader.size <= len(self.data):
+            firstFrame, lastFrame, count, length = ActionLog.chunkHeader.unpack_from(self.data, offset)
+            offset += ActionLog.chunkHeader.size
+            if offset + length > len(self.data):
+                break
+            self.chunks.append((firstFrame, lastFrame, offset, length))
+            offset += length
+
+    def getLastFrame(self):
+        return self.chunks[-1][1] if self.chunks else 0
+
+    # The game is on the recorded map, or on mapPath if the map has moved.
+    # Either way it has to be the map the replay was recorded on
+    def createGame(self, mapPath = None):
+        game = Game(redisConn = MemoryConn(), vectorBullets = self.vectorBullets, framePerSec = self.framePerSec,
+                sweptCollision = self.sweptCollision, mapPath = mapPath if mapPath != None else self.mapPath)
+        if game.gameMap.getCrc() != self.mapCrc:
+            raise ValueError("Replay was recorded on map {}, not {}".format(self.mapPath, game.mapPath))
+        GameSnapshot.loads(self.snapshot, game)
+        return game
+
+    # (frame, steps, actions) of every record up to toFrame
+    def getRecords(self, toFrame = None):
+        for firstFrame, lastFrame, offset, length in self.chunks:
+            if toFrame != None and firstFrame > toFrame:
+                return
+            data = zlib.decompress(self.data[offset:offset + length])
+            pos = 0
+            while pos < len(data):
+                frame, steps, payloadLength = ActionLog.record.unpack_from(data, pos)
+                pos += ActionLog.record.size
+                if toFrame != None and frame > toFrame:
+                    return
+                actions = json.loads(data[pos:pos + payloadLength]) if steps == 0 else None
+                pos += payloadLength
+                yield frame, steps, actions
+
+    # Simulate game up to toFrame, or the end of the log
+    def run(self, game, toFrame = None):
+        for frame, steps, actions in self.getRecords(toFrame):
+            while game.currFrame < frame:
+                game.updateFrame()
+            if steps:
+                game.updateFrame(steps)
+            else:
+                game.doActions(actions)
+            game.eventQueue = []
+        if toFrame != None:
+            while game.currFrame < toFrame:
+                game.updateFrame()
+        return game
+
+# Collects the writes of a tick and sends them in one pipelined round trip
+# from a single writer greenlet. While a flush is in flight, a newer set
+# of the same key or hash field replaces the pending one, so slow redis
+# drops stale state instead of queueing it. Pending publishes are capped
+class WriteBuffer:
+    def __init__(self, maxPublishes = 1000):
+        self.maxPublishes = maxPublishes
+        self.pendingSets = {}
+        self.pendingHashes = {}
+        self.pendingPublishes = collections.deque()
+        self.pendingLatest = {}
+        self.flushEvent = None
+        self.writer = None
+        self.flushes = 0
+        self.commands = 0
+        self.replacedSets = 0
+        self.droppedPublishes = 0
+        self.replacedPublishes = 0
+
+    def set(self, key, value, ex = None):
+        if key in self.pendingSets:
+            self.replacedSets += 1
+        self.pendingSets[key] = (value, ex)
+
+    # A pending set with value None deletes the key
+    def delete(self, key):
+        self.set(key, None)
+
+    def hset(self, key, mapping):
+        if key not in self.pendingHashes:
+            self.pendingHashes[key] = {}
+        self.pendingHashes[key].update(mapping)
+
+    def publish(self, channel, message):
+        if len(self.pendingPublishes) >= self.maxPublishes:
+            self.pendingPublishes.popleft()
+            self.droppedPublishes += 1
+        self.pendingPublishes.append((channel, message))
+
+    # Only the last message published to channel before a flush is sent,
+    # like sets, and it does not push other publishes out of the queue.
+    # For per-player views
+    def publishLatest(self, channel, message):
+        if channel in self.pendingLatest:
+            self.replacedPublishes += 1
+        self.pendingLatest[channel] = message
+
+    def flush(self):
+        if self.pendingSets or self.pendingHashes or self.pendingPublishes or self.pendingLatest:
+            if not self.isRunning():
+                self.start()
+            self.flushEvent.set()
+
+    def isRunning(self):
+        return self.writer != None and not self.writer.dead
+
+    # The writer is started by the first flush, not when the buffer is made
+    def start(self):
+        self.flushEvent = gevent.event.Event()
+        self.writer = gevent.spawn(self.runWriter)
+
+    # Everything written since the last call, as (sets, hashes, publishes)
+    def takePending(self):
+        sets = self.pendingSets
+        hashes = self.pendingHashes
+        publishes = self.pendingPublishes
+        publishes.extend(self.pendingLatest.items())
+        self.pendingSets = {}
+        self.pendingHashes = {}
+        self.pendingPublishes = collections.deque()
+        self.pendingLatest = {}
+        self.flushes += 1
+        self.commands += len(sets) + len(hashes) + len(publishes)
+        return sets, hashes, publishes
+
+    # A writer stopped by an unexpected error is started again by the
+    # next flush, the writes it had taken are lost
+    def runWriter(self):
+        try:
+            while True:
+                self.flushEvent.wait()
+                self.flushEvent.clear()
+                sets, hashes, publishes = self.takePending()
+                pipe = getRedis().pipeline(transaction = False)
+                for key, (value, ex) in sets.items():
+                    if value == None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, value, ex = ex)
+                for key, mapping in hashes.items():
+                    pipe.hmset(key, mapping)
+                for channel, message in publishes:
+                    pipe.publish(channel, message)
+                try:
+                    pipe.execute()
+                except redis.RedisError as e:
+                    print("Redis write failed", e)
+        except Exception as e:
+            print("Redis writer stopped", repr(e))
+
+    def getInfo(self):
+        ret = {}
+        ret['flushes'] = self.flushes
+        ret['commands'] = self.commands
+        ret['replacedSets'] = self.replacedSets
+        ret['droppedPublishes'] = self.droppedPublishes
+        ret['replacedPublishes'] = self.replacedPublishes
+        return ret
+
+# What a Game reads and writes through. Keys and channels are put in the
+# namespace of the room and written in every format a client asked for.
+# Subclasses store the encoded values in setValue, setHash and
+# publishMessage, and action messages are queued by onMessage. Game.run
+# and RoomManager use the blocking calls, Game.runAsync the Async ones
+class Transport:
+    serializers = {'json': JsonSerializer(), 'bin': PackedSerializer()}
+
+    def __init__(self, namespace = ''):
+        self.namespace = namespace
+        # Json is always written for old clients, other formats are
+        # written once a client asks for them
+        self.formats = set(['json'])
+        self.actionBatches = collections.deque()
+        self.actionChannels = {(self.getName('actions') + s.suffix).encode('utf-8'): s for s in self.serializers.values()}
+
+    def getName(self, name):
+        if self.namespace:
+            return self.namespace + ':' + name
+        return name
+
+    def useFormat(self, name):
+        if name in self.serializers:
+            self.formats.add(name)
+        else:
+            print("Unknown format", name)
+
+    # Messages are queued undecoded, ActionIngest decodes them in the tick
+    def onMessage(self, message):
+        self.actionBatches.append((self.actionChannels[message['channel']], message.get('data')))
+
+    # (serializer, data) of every action message received since last call
+    def getActionBatches(self):
+        ret = list(self.actionBatches)
+        self.actionBatches.clear()
+        return ret
 
     def setDynamicGameInfo(self, info):
-        gevent.spawn(redisConn.set, "dynamicGameInfo", json.dumps(info), ex=3600)
-        gevent.sleep(0)
+        for name in self.formats:
+            serializer = self.serializers[name]
+            self.setValue(self.getName("dynamicGameInfo") + serializer.suffix, serializer.dumpsState(info), ex = 3600)
+
+    def setStats(self, stats):
+        self.setHash(self.getName("frameStats"), {key: json.dumps(value) for key, value in stats.items()})
+
+    def publish(self, channel, message):
+        for name in self.formats:
+            serializer = self.serializers[name]
+            self.publishMessage(self.getName(channel) + serializer.suffix, serializer.dumps(message))
+
+    def publishDelta(self, delta):
+        self.publish('dynamicGameDelta', delta)
+
+    # Like publishMessage, but a transport that buffers writes only needs
+    # to send the last message of a channel
+    def publishLatest(self, channel, message):
+        self.publishMessage(channel, message)
+
+    def publishView(self, channel, info):
+        for name in self.formats:
+            serializer = self.serializers[name]
+            self.publishLatest(self.getName('view:{}'.format(channel)) + serializer.suffix, serializer.dumpsState(info))
 
     def publishEvent(self, event):
-        gevent.spawn(redisConn.publish, 'events', json.dumps({'infoType':'event', 'event':event}))
-        gevent.sleep(0)
+        self.publish('events', {'infoType':'event', 'event':event})
 
     def publishJoin(self, channel, id):
-        gevent.spawn(redisConn.publish, 'events', json.dumps({'infoType':'joinInfo', 'channel':channel, 'id': id}))
-        gevent.sleep(0)
+        self.publish('events', {'infoType':'joinInfo', 'channel':channel, 'id': id})
 
-    def getActions(self):
-        ret = []
-        while not self.actionQueue.empty():
-            ret.append(self.actionQueue.get())
+    def setValue(self, key, value, ex = None):
+        raise NotImplementedError
+
+    def setHash(self, key, mapping):
+        raise NotImplementedError
+
+    def publishMessage(self, channel, message):
+        raise NotImplementedError
+
+    # body is GameSnapshot.pack output. It may be written later, or
+    # skipped while the last one is still being written
+    def setSnapshot(self, body):
+        raise NotImplementedError
+
+    # Like setSnapshot, but the snapshot is stored when this returns
+    def saveSnapshot(self, body):
+        raise NotImplementedError
+
+    # GameSnapshot.dumps output, or None
+    def getSnapshot(self):
+        raise NotImplementedError
+
+    def deleteSnapshot(self):
+        raise NotImplementedError
+
+    # Block until an action message is queued or timeout seconds passed
+    def waitForActions(self, timeout):
+        raise NotImplementedError
+
+    # Counters of the writes, for the frame stats
+    def getWriteInfo(self):
+        return {}
+
+    # Send everything written since the last flush
+    def flush(self):
+        pass
+
+    async def connect(self):
+        pass
+
+    async def saveSnapshotAsync(self, body):
+        self.saveSnapshot(body)
+
+    async def getSnapshotAsync(self):
+        return self.getSnapshot()
+
+    async def waitForActionsAsync(self, timeout):
+        if not self.actionBatches and timeout > 0:
+            await asyncio.sleep(timeout)
+
+# Transport on redis-py under gevent. Writes are pipelined by a WriteBuffer
+# greenlet, actions come in on a pubsub greenlet
+class RedisConn(Transport):
+    def __init__(self, namespace = '', listen = True, writeBuffer = None):
+        Transport.__init__(self, namespace)
+        self.writeBuffer = writeBuffer if writeBuffer != None else WriteBuffer()
+        self.actionEvent = gevent.event.Event()
+        self.snapshotWriter = None
+        # Without listen, the owner feeds action messages through onMessage
+        if listen:
+            self.pubsub = getRedis().pubsub()
+            self.pubsub.subscribe(*self.actionChannels)
+            self.actionLoader = gevent.spawn(self.runActionQueue)
+            gevent.sleep(0)
+
+    def runActionQueue(self):
+        for message in self.pubsub.listen():
+            if message['type'] == 'message':
+                self.onMessage(message)
+
+    def onMessage(self, message):
+        Transport.onMessage(self, message)
+        self.actionEvent.set()
+
+    def setValue(self, key, value, ex = None):
+        self.writeBuffer.set(key, value, ex = ex)
+
+    def setHash(self, key, mapping):
+        self.writeBuffer.hset(key, mapping)
+
+    def publishMessage(self, channel, message):
+        self.writeBuffer.publish(channel, message)
+
+    def publishLatest(self, channel, message):
+        self.writeBuffer.publishLatest(channel, message)
+
+    # body is GameSnapshot.pack output. It is compressed in gevent's thread
+    # pool off the game loop, and skipped while the last one is in flight
+    def setSnapshot(self, body):
+        if self.snapshotWriter == None or self.snapshotWriter.dead:
+            self.snapshotWriter = gevent.spawn(self.writeSnapshot, body)
+
+    # With direct, the snapshot is in redis when this returns
+    def writeSnapshot(self, body, direct = False):
+        data = gevent.get_hub().threadpool.apply(GameSnapshot.compress, (body,))
+        if direct:
+            getRedis().set(self.getName("snapshot"), data, ex = 3600)
+        else:
+            self.writeBuffer.set(self.getName("snapshot"), data, ex = 3600)
+            self.writeBuffer.flush()
+
+    def saveSnapshot(self, body):
+        if self.snapshotWriter != None:
+            self.snapshotWriter.kill()
+        self.writeSnapshot(body, direct = True)
+
+    def getSnapshot(self):
+        return getRedis().get(self.getName("snapshot"))
+
+    def deleteSnapshot(self):
+        if self.snapshotWriter != None:
+            self.snapshotWriter.kill()
+        self.writeBuffer.delete(self.getName("snapshot"))
+        self.writeBuffer.flush()
+
+    def flush(self):
+        self.writeBuffer.flush()
+
+    def getWriteInfo(self):
+        return self.writeBuffer.getInfo()
+
+    def waitForActions(self, timeout):
+        if not self.actionBatches and timeout > 0:
+            self.actionEvent.clear()
+            self.actionEvent.wait(timeout)
+
+# Error reply from redis
+class RespError(Exception):
+    pass
+
+# Minimal asyncio redis client speaking RESP2 on one connection. It
+# connects on the first command, and a pipeline of commands is one write
+# and one wait for all the replies
+class AsyncRedisClient:
+    def __init__(self, url = None):
+        self.url = url or REDIS_URL or 'redis://localhost:6379'
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.commands = 0
+        self.roundTrips = 0
+
+    @staticmethod
+    def encode(args):
+        ret = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if type(arg) != bytes:
+                arg = str(arg).encode('utf-8')
+            ret.append(b'$%d\r\n' % len(arg))
+            ret.append(arg)
+            ret.append(b'\r\n')
+        return b''.join(ret)
+
+    async def open(self):
+        url = urllib.parse.urlparse(self.url)
+        reader, writer = await asyncio.open_connection(url.hostname or 'localhost', url.port or 6379,
+                ssl = True if url.scheme == 'rediss' else None)
+        setup = []
+        if url.password:
+            setup.append(('AUTH', url.password))
+        if url.path.strip('/'):
+            setup.append(('SELECT', url.path.strip('/')))
+        self.reader = reader
+        self.writer = writer
+        for args in setup:
+            self.writer.write(self.encode(args))
+            reply = await self.readReply()
+            if isinstance(reply, RespError):
+                self.close()
+                raise reply
+
+    def close(self):
+        if self.writer != None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    # Error replies are returned, not raised, so one bad command does not
+    # lose the replies of the rest of a pipeline
+    async def readReply(self):
+        line = await self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Redis closed the connection")
+        kind = line[:1]
+        line = line[1:-2]
+        if kind == b'+':
+            return line
+        if kind == b'-':
+            return RespError(line.decode('utf-8'))
+        if kind == b':':
+            return int(line)
+        if kind == b'$':
+            if int(line) < 0:
+                return None
+            return (await self.reader.readexactly(int(line) + 2))[:-2]
+        if kind == b'*':
+            if int(line) < 0:
+                return None
+            return [await self.readReply() for i in range(int(line))]
+        raise RespError("Bad reply {}".format(kind + line))
+
+    # Write a command without waiting for its reply, for pubsub
+    async def send(self, *args):
+        if self.writer == None:
+            await self.open()
+        self.writer.write(self.encode(args))
+        await self.writer.drain()
+
+    async def pipeline(self, commands):
+        async with self.lock:
+            if self.writer == None:
+                await self.open()
+            try:
+                self.writer.write(b''.join(self.encode(args) for args in commands))
+                await self.writer.drain()
+                replies = [await self.readReply() for args in commands]
+            except (OSError, asyncio.IncompleteReadError):
+                # Connect again on the next command
+                self.close()
+                raise
+        self.commands += len(commands)
+        self.roundTrips += 1
+        return replies
+
+    async def execute(self, *args):
+        reply = (await self.pipeline([args]))[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def getInfo(self):
+        return {'commands': self.commands, 'roundTrips': self.roundTrips}
+
+# Subscriber on a connection of its own, as a subscribed connection can
+# not send other commands. Messages are given to handler as redis-py
+# message dicts, and the channels are subscribed again after a reconnect
+class AsyncPubSub:
+    def __init__(self, handler, url = None):
+        self.client = AsyncRedisClient(url)
+        self.handler = handler
+        self.channels = set()
+        self.listener = None
+
+    async def subscribe(self, *channels):
+        channels = [c if type(c) == bytes else c.encode('utf-8') for c in channels]
+        self.channels.update(channels)
+        if self.listener == None:
+            self.listener = asyncio.get_running_loop().create_task(self.run())
+        elif self.client.writer != None:
+            await self.client.send('SUBSCRIBE', *channels)
+
+    async def unsubscribe(self, *channels):
+        channels = [c if type(c) == bytes else c.encode('utf-8') for c in channels]
+        self.channels.difference_update(channels)
+        if channels and self.client.writer != None:
+            await self.client.send('UNSUBSCRIBE', *channels)
+
+    async def run(self):
+        while True:
+            try:
+                if self.channels:
+                    await self.client.send('SUBSCRIBE', *self.channels)
+                else:
+                    await self.client.open()
+                while True:
+                    reply = await self.client.readReply()
+                    if type(reply) == list and reply[0] == b'message':
+                        self.handler({'type': 'message', 'channel': reply[1], 'data': reply[2]})
+            except (OSError, asyncio.IncompleteReadError) as e:
+                print("Redis subscriber lost, reconnect", e)
+                self.client.close()
+                await asyncio.sleep(1)
+
+    def close(self):
+        if self.listener != None:
+            self.listener.cancel()
+            self.listener = None
+        self.client.close()
+
+# WriteBuffer flushed by an asyncio task as one pipeline on client
+class AsyncWriteBuffer(WriteBuffer):
+    def __init__(self, client, maxPublishes = 1000):
+        WriteBuffer.__init__(self, maxPublishes = maxPublishes)
+        self.client = client
+
+    def start(self):
+        self.flushEvent = asyncio.Event()
+        self.writer = asyncio.get_running_loop().create_task(self.runWriter())
+
+    def isRunning(self):
+        return self.writer != None and not self.writer.done()
+
+    # Pending writes as redis commands
+    def takeCommands(self):
+        sets, hashes, publishes = self.takePending()
+        commands = []
+        for key, (value, ex) in sets.items():
+            if value == None:
+                commands.append(('DEL', key))
+            elif ex != None:
+                commands.append(('SET', key, value, 'EX', ex))
+            else:
+                commands.append(('SET', key, value))
+        for key, mapping in hashes.items():
+            args = ['HMSET', key]
+            for field, value in mapping.items():
+                args.append(field)
+                args.append(value)
+            commands.append(args)
+        for channel, message in publishes:
+            commands.append(('PUBLISH', channel, message))
+        return commands
+
+    async def runWriter(self):
+        try:
+            while True:
+                await self.flushEvent.wait()
+                self.flushEvent.clear()
+                try:
+                    for reply in await self.client.pipeline(self.takeCommands()):
+                        if isinstance(reply, RespError):
+                            print("Redis write failed", reply)
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    print("Redis write failed", e)
+        except Exception as e:
+            print("Redis writer stopped", repr(e))
+
+    def getInfo(self):
+        ret = WriteBuffer.getInfo(self)
+        ret['roundTrips'] = self.client.roundTrips
         return ret
 
+# Transport on asyncio, for Game.runAsync. Nothing connects until
+# connect is awaited. Writes share one connection and are pipelined once
+# per flush, actions come in on a second connection that only subscribes
+class AsyncRedisConn(Transport):
+    def __init__(self, namespace = '', listen = True, url = None, client = None, writeBuffer = None):
+        Transport.__init__(self, namespace)
+        self.url = url
+        self.listen = listen
+        self.client = client if client != None else AsyncRedisClient(url)
+        self.writeBuffer = writeBuffer if writeBuffer != None else AsyncWriteBuffer(self.client)
+        self.pubsub = None
+        self.actionEvent = asyncio.Event()
+        self.snapshotWriter = None
+
+    async def connect(self):
+        await self.client.execute('PING')
+        if self.listen and self.pubsub == None:
+            self.pubsub = AsyncPubSub(self.onMessage, self.url)
+            await self.pubsub.subscribe(*self.actionChannels)
+
+    def close(self):
+        if self.pubsub != None:
+            self.pubsub.close()
+            self.pubsub = None
+        self.client.close()
+
+    def onMessage(self, message):
+        Transport.onMessage(self, message)
+        self.actionEvent.set()
+
+    def setValue(self, key, value, ex = None):
+        self.writeBuffer.set(key, value, ex = ex)
+
+    def setHash(self, key, mapping):
+        self.writeBuffer.hset(key, mapping)
+
+    def publishMessage(self, channel, message):
+        self.writeBuffer.publish(channel, message)
+
+    def publishLatest(self, channel, message):
+        self.writeBuffer.publishLatest(channel, message)
+
+    # Compressed in the loop's default executor, and skipped while the
+    # last one is in flight
+    def setSnapshot(self, body):
+        if self.snapshotWriter == None or self.snapshotWriter.done():
+            self.snapshotWriter = asyncio.get_running_loop().create_task(self.writeSnapshot(body))
+
+    async def writeSnapshot(self, body, direct = False):
+        data = await asyncio.get_running_loop().run_in_executor(None, GameSnapshot.compress, body)
+        if direct:
+            await self.client.execute('SET', self.getName("snapshot"), data, 'EX', 3600)
+        else:
+            self.writeBuffer.set(self.getName("snapshot"), data, ex = 3600)
+            self.writeBuffer.flush()
+
+    # The blocking calls of Transport would stall the loop, so only the
+    # Async ones are here
+    def saveSnapshot(self, body):
+        raise RuntimeError("AsyncRedisConn can not block, await saveSnapshotAsync")
+
+    def getSnapshot(self):
+        raise RuntimeError("AsyncRedisConn can not block, await getSnapshotAsync")
+
+    def waitForActions(self, timeout):
+        raise RuntimeError("AsyncRedisConn can not block, await waitForActionsAsync")
+
+    async def saveSnapshotAsync(self, body):
+        if self.snapshotWriter != None:
+            self.snapshotWriter.cancel()
+        await self.writeSnapshot(body, direct = True)
+
+    async def getSnapshotAsync(self):
+        return await self.client.execute('GET', self.getName("snapshot"))
+
+    def deleteSnapshot(self):
+        if self.snapshotWriter != None:
+            self.snapshotWriter.cancel()
+        self.writeBuffer.delete(self.getName("snapshot"))
+        self.writeBuffer.flush()
+
+    def flush(self):
+        self.writeBuffer.flush()
+
+    def getWriteInfo(self):
+        return self.writeBuffer.getInfo()
+
+    async def waitForActionsAsync(self, timeout):
+        if not self.actionBatches and timeout > 0:
+            self.actionEvent.clear()
+            try:
+                await asyncio.wait_for(self.actionEvent.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+# Redis server stand-in on an asyncio loop with the commands the
+# transports use, so AsyncRedisConn can be run and measured in process.
+# Keys do not expire
+class LocalRedis:
+    def __init__(self):
+        self.data = {}
+        # channel -> writers of the connections subscribed to it
+        self.subscribers = {}
+        # writer -> handler task of every open connection
+        self.clients = {}
+        self.server = None
+        self.commands = 0
+
+    async def start(self, host = '127.0.0.1', port = 0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return 'redis://{}:{}'.format(host, port)
+
+    # Connections are closed too, so their handlers end before the loop
+    async def close(self):
+        if self.server != None:
+            self.server.close()
+            handlers = list(self.clients.values())
+            for writer in list(self.clients):
+                writer.close()
+            await asyncio.gather(*handlers)
+            self.server = None
+
+    @staticmethod
+    def encodeReply(reply):
+        if reply == None:
+            return b'$-1\r\n'
+        if type(reply) == str:
+            return b'+' + reply.encode('utf-8') + b'\r\n'
+        if isinstance(reply, RespError):
+            return b'-' + str(reply).encode('utf-8') + b'\r\n'
+        if type(reply) == int:
+            return b':%d\r\n' % reply
+        if type(reply) == list:
+            return b'*%d\r\n' % len(reply) + b''.join(LocalRedis.encodeReply(r) for r in reply)
+        return b'$%d\r\n' % len(reply) + reply + b'\r\n'
+
+    async def readCommand(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if line[:1] != b'*':
+            return line.split()
+        args = []
+        for i in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    async def handle(self, reader, writer):
+        channels = set()
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                args = await self.readCommand(reader)
+                if args == None:
+                    break
+                self.commands += 1
+                writer.write(self.execute(args, writer, channels))
+                await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in channels:
+                self.subscribers[channel].discard(writer)
+            self.clients.pop(writer, None)
+            writer.close()
+
+    # The encoded replies of one command
+    def execute(self, args, writer, channels):
+        name = args[0].upper()
+        if name in (b'SUBSCRIBE', b'UNSUBSCRIBE'):
+            ret = []
+            for channel in args[1:]:
+                if name == b'SUBSCRIBE':
+                    channels.add(channel)
+                    self.subscribers.setdefault(channel, set()).add(writer)
+                else:
+                    channels.discard(channel)
+                    self.subscribers.get(channel, set()).discard(writer)
+                ret.append(self.encodeReply([name.lower(), channel, len(channels)]))
+            return b''.join(ret)
+        if name == b'PUBLISH':
+            receivers = self.subscribers.get(args[1], ())
+            for w in receivers:
+                w.write(self.encodeReply([b'message', args[1], args[2]]))
+            return self.encodeReply(len(receivers))
+        if name == b'SET':
+            self.data[args[1]] = args[2]
+            return self.encodeReply('OK')
+        if name == b'GET':
+            value = self.data.get(args[1])
+            if type(value) == dict:
+                return self.encodeReply(RespError("WRONGTYPE Operation against a key holding the wrong kind of value"))
+            return self.encodeReply(value)
+        if name == b'DEL':
+            return self.encodeReply(sum(self.data.pop(key, None) != None for key in args[1:]))
+        if name in (b'HSET', b'HMSET'):
+            mapping = self.data.setdefault(args[1], {})
+            for i in range(2, len(args) - 1, 2):
+                mapping[args[i]] = args[i+1]
+            return self.encodeReply('OK' if name == b'HMSET' else (len(args) - 2) // 2)
+        if name == b'HGETALL':
+            ret = []
+            for field, value in self.data.get(args[1], {}).items():
+                ret.append(field)
+                ret.append(value)
+            return self.encodeReply(ret)
+        if name == b'PING':
+            return self.encodeReply('PONG')
+        if name in (b'AUTH', b'SELECT'):
+            return self.encodeReply('OK')
+        return self.encodeReply(RespError("ERR unknown command '{}'".format(name.decode('utf-8', 'replace'))))
+
+# Serializer for messages that are already python objects
+class RawSerializer:
+    suffix = ''
+
+    def dumps(self, obj):
+        return obj
+
+    def loads(self, data):
+        return data
+
+    def dumpsState(self, info):
+        return info
+
+    def loadsState(self, data):
+        return data
+
+# Transport that keeps everything in memory, for tests, benchmarks and
+# games with no redis. Actions are given with sendActions, the latest
+# value of every key is in state and the latest published messages are
+# in published
+class MemoryConn(Transport):
+    serializers = {'json': JsonSerializer(), 'bin': PackedSerializer(), 'raw': RawSerializer()}
+
+    def __init__(self, namespace = '', format = 'json', maxPublished = 1000):
+        Transport.__init__(self, namespace)
+        self.formats = set([format])
+        self.state = {}
+        self.published = collections.deque(maxlen = maxPublished)
+        self.writes = 0
+
+    def sendActions(self, actions):
+        self.actionBatches.append((self.serializers['raw'], actions))
+
+    def waitForActions(self, timeout):
+        if not self.actionBatches and timeout > 0:
+            gevent.sleep(timeout)
+
+    def setValue(self, key, value, ex = None):
+        self.state[key] = value
+        self.writes += 1
+
+    def setHash(self, key, mapping):
+        self.state.setdefault(key, {}).update(mapping)
+        self.writes += 1
+
+    def publishMessage(self, channel, message):
+        self.published.append((channel, message))
+        self.writes += 1
+
+    def setSnapshot(self, body):
+        self.setValue(self.getName("snapshot"), GameSnapshot.compress(body))
+
+    def saveSnapshot(self, body):
+        self.setSnapshot(body)
+
+    def getSnapshot(self):
+        return self.state.get(self.getName("snapshot"))
+
+    def deleteSnapshot(self):
+        self.state.pop(self.getName("snapshot"), None)
+
+    def getWriteInfo(self):
+        return {'writes': self.writes}
+
+transports = {'gevent': RedisConn, 'asyncio': AsyncRedisConn, 'memory': MemoryConn}
+
+def createTransport(name, **kw):
+    if name not in transports:
+        raise ValueError("Unknown transport {}, choose from {}".format(name, ", ".join(transports)))
+    return transports[name](**kw)
+
 if __name__ == '__main__':
-    g = Game()
-    g.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", default = None, help = "comma separated room names to host in this process")
+    parser.add_argument("--workers", type = int, default = None, help = "run a worker process per core, or this many, behind the lobby")
+    parser.add_argument("--headless", type = int, default = None, metavar = "FRAMES", help = "run this many frames without redis as fast as possible")
+    parser.add_argument("--seed", type = int, default = None)
+    parser.add_argument("--record", default = None, metavar = "PATH", help = "record an ActionLog replay of the game")
+    parser.add_argument("--replay", default = None, metavar = "PATH", help = "play an ActionLog and print the game info at the end")
+    parser.add_argument("--frame", type = int, default = None, help = "with --replay, stop at this frame")
+    parser.add_argument("--map", default = None, help = "map file or Tiled JSON map, for a single game or headless. With --replay, the recorded map if it has moved")
+    parser.add_argument("--transport", default = TRANSPORT, choices = sorted(transports), help = "transport of a single game, rooms and workers run on gevent")
+    parser.add_argument("--convert-map", nargs = 2, default = None, metavar = ("JSON", "PATH"), help = "convert a Tiled JSON map to a map file")
+    args = parser.parse_args()
+    if args.convert_map != None:
+        start = time.time()
+        m = Map(fileName = args.convert_map[0])
+        m.saveFile(args.convert_map[1])
+        print("{}x{} map in {:.3f}s".format(m.width, m.height, time.time() - start))
+        sys.exit(0)
+    if args.replay != None:
+        replay = Replay(args.replay)
+        start = time.time()
+        g = replay.run(replay.createGame(args.map), args.frame)
+        print("{} frames in {:.3f}s".format(g.currFrame, time.time() - start), file = sys.stderr)
+        print(json.dumps(g.getDynamicGameInfo()))
+        sys.exit(0)
+    if args.map == None:
+        args.map = MAP_PATH
+    if args.headless != None:
+        g = Game(redisConn = MemoryConn(), seed = args.seed, mapPath = args.map)
+        if args.record != None:
+            g.recorder = ActionLog(args.record, g)
+        start = time.time()
+        g.runHeadless(args.headless)
+        print("{} frames in {:.3f}s".format(args.headless, time.time() - start))
+        if g.recorder != None:
+            g.recorder.close()
+        sys.exit(0)
+    if args.transport != 'memory' and not REDIS_URL:
+        print("No redis url!")
+        sys.exit(1)
+    if args.workers != None:
+        monkey.patch_all()
+        Supervisor(workers = args.workers).run()
+    elif args.rooms:
+        monkey.patch_all()
+        manager = RoomManager()
+        for name in args.rooms.split(','):
+            manager.addRoom(name)
+        manager.run()
+    else:
+        if args.transport == 'gevent':
+            monkey.patch_all()
+        g = Game(redisConn = createTransport(args.transport), mapPath = args.map)
+        if args.record != None:
+            g.recorder = ActionLog(args.record, g)
+        if args.transport == 'asyncio':
+            asyncio.run(g.runAsync())
+        else:
+            g.run()
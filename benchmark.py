@@ -0,0 +1,612 @@
+import os
+import sys
+import gc
+import math
+import time
+import json
+import random
+import tracemalloc
+import tempfile
+import asyncio
+
+import battle_field as bf
+
+weaponTypes = [bf.WeaponPistol, bf.WeaponMp40, bf.WeaponMp43, bf.WeaponM1, bf.WeaponFg42, bf.WeaponAr]
+
+def makeGame(players, vectorBullets = False, seed = 0, framePerSec = 60, sweptCollision = False, mapPath = bf.MAP_PATH):
+    game = bf.Game(redisConn = bf.MemoryConn(), vectorBullets = vectorBullets, seed = seed,
+            framePerSec = framePerSec, sweptCollision = sweptCollision, mapPath = mapPath)
+    for i in range(players):
+        game.joinGame('bench{}'.format(i), 'bench{}'.format(i))
+    return game
+
+def spawnBullets(game, count):
+    while game.getBulletCount() < count:
+        weapon = random.choice(weaponTypes)()
+        for feature in random.sample(bf.BULLET_FEATURES, random.randint(0, 2)):
+            weapon.addFeature(feature)
+        x, y = game.gameMap.getRandomWalkableCoord()
+        bList = weapon.fire(pos = bf.Point(x, y), angle = random.uniform(-3.14, 3.14), player = bf.Player(), currTime = weapon.gap + 1, id = game.bulletId)
+        for b in bList:
+            game.addBullet(b)
+            game.bulletId += 1
+
+def benchBullets(bullets, players = 10, frames = 300):
+    ret = {}
+    for vectorBullets in [False, True]:
+        random.seed(0)
+        game = makeGame(players, vectorBullets)
+        total = 0
+        for i in range(frames):
+            spawnBullets(game, bullets)
+            # Bullets are not allowed to kill anyone during the benchmark
+            for p in game.players:
+                p.hp = 100000
+                p.lastAction = game.currFrame / game.framePerSec
+            start = time.perf_counter()
+            game.updateBullets(1.0 / game.framePerSec)
+            game.checkHit()
+            total += time.perf_counter() - start
+        ret['numpy' if vectorBullets else 'python'] = total / frames
+    return ret
+
+# Bots wander around and shoot at random spots, like a busy match
+def botActions(game, moveChance = 0.02, shootChance = 0.05):
+    actions = []
+    for p in game.players:
+        p.lastAction = game.currFrame / game.framePerSec
+        if random.uniform(0, 1) < moveChance:
+            x, y = game.gameMap.getRandomWalkableCoord()
+            actions.append({'actionType':'move', 'player':p.id, 'x':x, 'y':y})
+        if random.uniform(0, 1) < shootChance:
+            actions.append({'actionType':'shoot', 'player':p.id, 'x':random.uniform(0, 1920), 'y':random.uniform(0, 1920)})
+    return actions
+
+def benchDelta(players, frames = 1200):
+    random.seed(0)
+    game = makeGame(players)
+    for p in game.players:
+        p.weapon = random.choice(weaponTypes)()
+    encoder = bf.DeltaEncoder(keyframeInterval = game.broadcastFreq)
+    fullBytes = deltaBytes = 0
+    fullTime = deltaTime = 0
+    broadcasts = 0
+    for i in range(frames):
+        game.doActions(botActions(game))
+        game.updateFrame()
+        if game.currFrame % int(game.framePerSec / game.broadcastFreq) == 0:
+            broadcasts += 1
+            start = time.perf_counter()
+            fullBytes += len(json.dumps(game.getDynamicGameInfo()))
+            fullTime += time.perf_counter() - start
+            start = time.perf_counter()
+            deltaBytes += len(json.dumps(encoder.encode(game.getDynamicGameInfo())))
+            deltaTime += time.perf_counter() - start
+    return {'fullBytes': fullBytes / broadcasts, 'deltaBytes': deltaBytes / broadcasts,
+            'fullTime': fullTime / broadcasts, 'deltaTime': deltaTime / broadcasts}
+
+def recordFrames(players, frames = 600):
+    random.seed(0)
+    game = makeGame(players)
+    for p in game.players:
+        p.weapon = random.choice(weaponTypes)()
+    ret = []
+    for i in range(frames):
+        game.doActions(botActions(game))
+        game.updateFrame()
+        if game.currFrame % int(game.framePerSec / game.broadcastFreq) == 0:
+            ret.append(game.getDynamicGameInfo())
+    return ret
+
+def benchSerializer(serializer, frames, repeat = 5):
+    size = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        for info in frames:
+            size += len(serializer.dumpsState(info))
+    total = time.perf_counter() - start
+    count = repeat * len(frames)
+    return {'bytes': size / count, 'time': total / count}
+
+def benchView(players, viewRadius = 500, frames = 600, mapPath = bf.MAP_PATH):
+    random.seed(0)
+    game = makeGame(players, mapPath = mapPath)
+    game.viewRadius = viewRadius
+    for p in game.players:
+        p.weapon = random.choice(weaponTypes)()
+    globalBytes = 0
+    viewBytes = 0
+    views = 0
+    viewTime = 0
+    broadcasts = 0
+    for i in range(frames):
+        game.doActions(botActions(game))
+        game.updateFrame()
+        if game.currFrame % int(game.framePerSec / game.broadcastFreq) == 0:
+            broadcasts += 1
+            globalBytes += len(json.dumps(game.getDynamicGameInfo()))
+            game.redisConn.published.clear()
+            start = time.perf_counter()
+            game.broadcastViews()
+            viewTime += time.perf_counter() - start
+            for channel, message in game.redisConn.published:
+                if channel.startswith('view:'):
+                    viewBytes += len(message)
+                    views += 1
+    return {'globalBytes': globalBytes / broadcasts, 'viewBytes': viewBytes / views,
+            'viewTime': viewTime / broadcasts}
+
+# Everyone holds an FG42 and fires all the time, so there are five bullets
+# per shot flying around
+def benchTicks(players, vectorBullets = False, frames = 600, warmup = 120):
+    random.seed(0)
+    game = makeGame(players, vectorBullets)
+    for i in range(warmup + frames):
+        if i == warmup:
+            game.frameStats.reset()
+            start = time.perf_counter()
+        for p in game.players:
+            if not isinstance(p.weapon, bf.WeaponFg42):
+                p.weapon = bf.WeaponFg42()
+        game.step(botActions(game, moveChance = 0.05, shootChance = 0.5))
+    total = time.perf_counter() - start
+    ret = game.frameStats.getInfo()
+    ret['ticksPerSec'] = frames / total
+    ret['bullets'] = game.getBulletCount()
+    return ret
+
+# Bytes held per live bullet, and the memory churned and Points created by
+# moving them and checking hits every frame
+def benchMemory(bullets = 10000, frames = 60):
+    random.seed(0)
+    game = makeGame(10)
+    for p in game.players:
+        p.hp = 100000
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    spawnBullets(game, bullets)
+    perBullet = (tracemalloc.get_traced_memory()[0] - start) / game.getBulletCount()
+
+    points = [0]
+    pointInit = bf.Point.__init__
+    def countingInit(self, x = 0, y = 0):
+        points[0] += 1
+        pointInit(self, x, y)
+    churn = 0
+    counted = 0
+    for i in range(frames):
+        spawnBullets(game, bullets)
+        for p in game.players:
+            p.lastAction = game.currFrame / game.framePerSec
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        bf.Point.__init__ = countingInit
+        game.updateBullets(1.0 / game.framePerSec)
+        game.checkHit()
+        bf.Point.__init__ = pointInit
+        churn += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {'bytesPerBullet': perBullet, 'churnPerFrame': churn / frames, 'pointsPerFrame': points[0] / frames}
+
+# M1s with four times the bullet speed, at lower tick rates. Reports the
+# CPU per simulated second, the hits, and how many bullet moves went
+# through a wall
+def benchSwept(framePerSec, sweptCollision, players = 50, seconds = 10):
+    random.seed(0)
+    game = makeGame(players, framePerSec = framePerSec, sweptCollision = sweptCollision)
+    for p in game.players:
+        p.weapon = bf.WeaponM1()
+        p.weapon.speed *= 4
+    hits = [0]
+    hitPlayer = game.hitPlayer
+    def countingHit(p, damage, attacker):
+        hits[0] += 1
+        hitPlayer(p, damage, attacker)
+    game.hitPlayer = countingHit
+    tunneled = 0
+    total = 0
+    scale = 60 / framePerSec
+    for i in range(seconds * framePerSec):
+        actions = botActions(game, moveChance = 0.05*scale, shootChance = 0.5*scale)
+        moved = game.bulletId
+        start = time.perf_counter()
+        game.step(actions)
+        total += time.perf_counter() - start
+        for b in game.bullets:
+            # Bullets fired by this step's actions have not moved yet, and
+            # penetrate ones are meant to go through walls
+            if b.id < moved and not b.hasFeature("penetrate") and game.gameMap.traceRay(b.lastX, b.lastY, b.pos.x, b.pos.y) != None:
+                tunneled += 1
+    return {'cpu': total / seconds, 'hits': hits[0], 'tunneled': tunneled}
+
+# Record a bot match, then replay it headless. Reports the log size, the
+# time spent recording per step and how much faster than real time the
+# replay runs
+def benchReplay(players, seconds = 60):
+    random.seed(0)
+    game = makeGame(players)
+    for p in game.players:
+        p.weapon = random.choice(weaponTypes)()
+    path = os.path.join(tempfile.mkdtemp(), 'bench.bfr')
+    game.recorder = bf.ActionLog(path, game)
+    recordActions = game.recorder.recordActions
+    recordTime = [0]
+    def timedRecord(frame, actions):
+        start = time.perf_counter()
+        recordActions(frame, actions)
+        recordTime[0] += time.perf_counter() - start
+    game.recorder.recordActions = timedRecord
+    frames = seconds * game.framePerSec
+    for i in range(frames):
+        game.step(botActions(game))
+    game.recorder.close()
+    replay = bf.Replay(path)
+    start = time.perf_counter()
+    replay.run(replay.createGame())
+    replayTime = time.perf_counter() - start
+    size = os.path.getsize(path)
+    os.remove(path)
+    return {'bytesPerMin': size / seconds * 60, 'recordTime': recordTime[0] / frames, 'speedup': seconds / replayTime}
+
+# FG42 storm with and without the bullet and item pools. Reports the
+# objects allocated, the collections run per generation and the time
+# spent in the gc per simulated second
+def benchAlloc(pooled, players = 50, seconds = 10):
+    random.seed(0)
+    game = makeGame(players)
+    if not pooled:
+        game.bulletPool.maxSize = 0
+        game.itemPool.maxSize = 0
+    collections = [0, 0, 0]
+    pause = [0, 0]
+    def onGc(phase, info):
+        if phase == 'start':
+            pause[1] = time.perf_counter()
+        else:
+            collections[info['generation']] += 1
+            pause[0] += time.perf_counter() - pause[1]
+    gc.collect()
+    gc.callbacks.append(onGc)
+    start = time.perf_counter()
+    for i in range(seconds * game.framePerSec):
+        for p in game.players:
+            if not isinstance(p.weapon, bf.WeaponFg42):
+                p.weapon = bf.WeaponFg42()
+        game.step(botActions(game, moveChance = 0.05, shootChance = 0.5))
+    total = time.perf_counter() - start
+    gc.callbacks.remove(onGc)
+    allocated = game.bulletPool.created + game.itemPool.created
+    reused = game.bulletPool.reused + game.itemPool.reused
+    return {'cpu': total / seconds, 'allocated': allocated / seconds, 'reused': reused / seconds,
+            'collections': [c / seconds for c in collections], 'gcTime': pause[0] / seconds}
+
+# Load time of a random Tiled JSON map and of the same map as a map file
+# Tiled JSON map of size x size tiles with random walls
+def writeJsonMap(path, size, wallChance = 0.1):
+    random.seed(0)
+    layer = [200 if random.random() < wallChance else 1 for i in range(size * size)]
+    with open(path, 'w') as f:
+        json.dump({'width': size, 'height': size, 'tilewidth': bf.GRID_SIZE, 'layers': [{'data': layer}]}, f)
+
+def benchMap(size, wallChance = 0.1):
+    directory = tempfile.mkdtemp()
+    jsonPath = os.path.join(directory, 'bench.json')
+    filePath = os.path.join(directory, 'bench.bfm')
+    writeJsonMap(jsonPath, size, wallChance)
+    start = time.perf_counter()
+    bf.Map(fileName = jsonPath).saveFile(filePath)
+    jsonTime = time.perf_counter() - start
+    start = time.perf_counter()
+    gameMap = bf.Map(fileName = filePath)
+    fileTime = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(1000):
+        gameMap.getRandomWalkableCoord()
+    coordTime = (time.perf_counter() - start) / 1000
+    fileSize = os.path.getsize(filePath)
+    del gameMap
+    os.remove(jsonPath)
+    os.remove(filePath)
+    os.rmdir(directory)
+    return {'jsonTime': jsonTime, 'fileTime': fileTime, 'coordTime': coordTime, 'bytes': fileSize}
+
+# One human and a room full of bots. Reports the time the bots take per
+# frame against the whole frame, and the NavField searches they needed
+def benchBots(bots, seconds = 20, warmup = 5):
+    game = makeGame(1, seed = 0)
+    game.bots.count = bots + 1
+    frames = seconds * game.framePerSec
+    for i in range(warmup * game.framePerSec + frames):
+        if i == warmup * game.framePerSec:
+            game.frameStats.reset()
+            searches = game.gameMap.getNavField().searches
+            decisions = game.bots.decisions
+        for p in game.players:
+            if p.channel != None:
+                p.lastAction = game.currFrame / game.framePerSec
+        game.step()
+    stats = game.frameStats.getInfo()
+    return {'bots': stats['bots']['avg'], 'frame': stats['frame']['avg'] + stats['bots']['avg'] + stats['doActions']['avg'],
+            'decisions': (game.bots.decisions - decisions) / seconds,
+            'searches': (game.gameMap.getNavField().searches - searches) / seconds}
+
+# Rays per second through Map.raycast on map.json from walkable origins
+# in random directions, one batch at a time
+def benchRaycast(rays, vectorized, maxDistance = 600, repeat = 5):
+    random.seed(0)
+    gameMap = bf.Map(fileName = 'map.json')
+    origins = [gameMap.getRandomWalkableCoord() for i in range(rays)]
+    x0 = [x for x, y in origins]
+    y0 = [y for x, y in origins]
+    angles = [random.uniform(-3.14, 3.14) for i in range(rays)]
+    if vectorized:
+        x0 = bf.np.array(x0)
+        y0 = bf.np.array(y0)
+        angles = bf.np.array(angles)
+    start = time.perf_counter()
+    for i in range(repeat):
+        gameMap.raycast(x0, y0, angles, maxDistance)
+    return {'raysPerSec': rays * repeat / (time.perf_counter() - start)}
+
+# Writes per second from an AsyncRedisConn to a LocalRedis on loopback,
+# as one pipeline per tick or one round trip per command
+def benchTransport(writesPerTick, pipelined, ticks = 100):
+    async def run():
+        local = bf.LocalRedis()
+        conn = bf.AsyncRedisConn(namespace = 'bench', listen = False, url = await local.start())
+        await conn.connect()
+        game = makeGame(10)
+        info = game.getDynamicGameInfo()
+        start = time.perf_counter()
+        for i in range(ticks):
+            conn.setDynamicGameInfo(info)
+            for j in range(writesPerTick - 1):
+                conn.publishEvent([{'type': 'hit', 'id': j}])
+            commands = conn.writeBuffer.takeCommands()
+            if pipelined:
+                await conn.client.pipeline(commands)
+            else:
+                for command in commands:
+                    await conn.client.execute(*command)
+        total = time.perf_counter() - start
+        roundTrips = conn.client.roundTrips
+        conn.close()
+        await local.close()
+        return {'writesPerSec': writesPerTick * ticks / total, 'tickTime': total / ticks, 'roundTrips': roundTrips / ticks}
+    return asyncio.run(run())
+
+# Round trips of the binary formats, so a change to one side of a format
+# fails here with an AssertionError instead of a room that drifts later.
+# A game restored from a snapshot must play the same as the original.
+# Buffs and items last 3 seconds and buffs are given a second before the
+# snapshot, so their timers run out after it on both sides
+def checkSnapshot(vectorBullets, players = 20, frames = 300, after = 300):
+    random.seed(0)
+    game = makeGame(players, vectorBullets, seed = 1)
+    game.featureLifetime = game.itemLifetime = 3
+    for p in game.players:
+        p.weapon = random.choice(weaponTypes)()
+    for i in range(frames):
+        if i == frames - game.framePerSec:
+            for p in game.players:
+                for feature in random.sample(bf.BULLET_FEATURES, random.randint(0, 2)):
+                    game.addFeature(p.weapon, feature)
+                if random.uniform(0, 1) < 0.3:
+                    game.addFeature(p, random.choice(bf.GameSnapshot.playerFeatures))
+        game.step(botActions(game, shootChance = 0.3))
+    restored = bf.Game(redisConn = bf.MemoryConn(), vectorBullets = vectorBullets)
+    restored.featureLifetime = restored.itemLifetime = 3
+    bf.GameSnapshot.loads(bf.GameSnapshot.dumps(game), restored)
+    for i in range(after):
+        actions = botActions(game, shootChance = 0.3)
+        restored.step(json.loads(json.dumps(actions)))
+        game.step(actions)
+        assert json.dumps(game.getDynamicGameInfo()) == json.dumps(restored.getDynamicGameInfo()), \
+                "restored game differs at frame {}".format(game.currFrame)
+
+# PackedSerializer state must load back as the info it was made from,
+# with positions and angles quantized
+def checkPacked(players = 50, frames = 300):
+    random.seed(0)
+    game = makeGame(players, seed = 1)
+    serializer = bf.PackedSerializer()
+    # Low hp so players die and the kill and death counters move
+    for p in game.players:
+        p.hp = random.randint(1, 30)
+        p.kill = random.randint(0, 1000)
+        p.death = random.randint(0, 1000)
+    for i in range(frames):
+        game.step(botActions(game, shootChance = 0.3))
+        info = game.getDynamicGameInfo()
+        info['seq'] = i
+        loaded = serializer.loadsState(serializer.dumpsState(info))
+        assert loaded['seq'] == i and abs(loaded['timestamp'] - info['timestamp']) < 1e-3, "header differs"
+        for kind in ['players', 'bullets', 'items']:
+            assert [e['id'] for e in loaded[kind]] == [e['id'] for e in info[kind]], "{} differ".format(kind)
+            for e, l in zip(info[kind], loaded[kind]):
+                # Pixels, clamped to the uint16 range
+                for axis in ['x', 'y']:
+                    assert abs(l[axis] - min(max(e[axis], 0), 0xffff)) <= 0.5, "{} position differs".format(kind)
+                if 'angle' in e:
+                    # 256 steps per turn
+                    diff = (l['angle'] - e['angle']) % (2*math.pi)
+                    assert min(diff, 2*math.pi - diff) <= math.pi / 256 + 1e-9, "{} angle differs".format(kind)
+                    assert l['speed'] == int(e['speed']), "{} speed differs".format(kind)
+        for e, l in zip(info['players'], loaded['players']):
+            assert l['hp'] == int(round(e['hp'])) and l['dead'] == e['dead'] and l['name'] == e['name'], "player differs"
+            assert (l['weapon'], l['kill'], l['death']) == (e['weapon'], e['kill'], e['death']), "player differs"
+            assert l['features'] == [f for f in serializer.playerFeatures if f in e['features']], "player features differ"
+        for e, l in zip(info['bullets'], loaded['bullets']):
+            assert l['size'] == int(e['size']), "bullet size differs"
+        for e, l in zip(info['items'], loaded['items']):
+            assert l['itemType'] == e['itemType'], "item type differs"
+    event = {'infoType':'event', 'event':[{'eventType':'bulletHit', 'player':1}]}
+    assert serializer.loads(serializer.dumps(event)) == event, "message differs"
+
+# Replaying an ActionLog, to a frame in the middle or to the end, must
+# give the game the recording saw. Small chunks so several are read
+def checkReplay(vectorBullets, players = 20, frames = 600):
+    random.seed(0)
+    game = makeGame(players, vectorBullets, seed = 1)
+    for p in game.players:
+        p.weapon = random.choice(weaponTypes)()
+        for feature in random.sample(bf.BULLET_FEATURES, random.randint(0, 2)):
+            game.addFeature(p.weapon, feature)
+    path = os.path.join(tempfile.mkdtemp(), 'check.bfr')
+    game.recorder = bf.ActionLog(path, game, chunkFrames = 100)
+    infos = {}
+    for i in range(frames):
+        game.step(botActions(game, shootChance = 0.3))
+        infos[game.currFrame] = json.dumps(game.getDynamicGameInfo())
+    game.recorder.close()
+    replay = bf.Replay(path)
+    os.remove(path)
+    mid = game.currFrame - frames // 2
+    assert json.dumps(replay.run(replay.createGame(), mid).getDynamicGameInfo()) == infos[mid], \
+            "replay differs at frame {}".format(mid)
+    assert json.dumps(replay.run(replay.createGame(), game.currFrame).getDynamicGameInfo()) == infos[game.currFrame], \
+            "replay differs at frame {}".format(game.currFrame)
+
+def runBullets():
+    if bf.np == None:
+        print("NumPy is not installed, skip bullets")
+        return
+    print("{:>8} {:>14} {:>14} {:>8}".format("bullets", "python ms", "numpy ms", "speedup"))
+    for bullets in [100, 1000, 5000, 10000]:
+        ret = benchBullets(bullets)
+        print("{:>8} {:>14.3f} {:>14.3f} {:>8.1f}".format(bullets, ret['python']*1000, ret['numpy']*1000, ret['python'] / ret['numpy']))
+
+def runDelta():
+    print("{:>8} {:>12} {:>12} {:>10} {:>10}".format("players", "full bytes", "delta bytes", "full ms", "delta ms"))
+    for players in [10, 50, 200]:
+        ret = benchDelta(players)
+        print("{:>8} {:>12.0f} {:>12.0f} {:>10.3f} {:>10.3f}".format(players, ret['fullBytes'], ret['deltaBytes'],
+                ret['fullTime']*1000, ret['deltaTime']*1000))
+
+def runSerializer():
+    print("{:>8} {:>8} {:>12} {:>10}".format("players", "format", "bytes", "encode ms"))
+    for players in [10, 50, 200]:
+        frames = recordFrames(players)
+        for name, serializer in sorted(bf.RedisConn.serializers.items()):
+            ret = benchSerializer(serializer, frames)
+            print("{:>8} {:>8} {:>12.0f} {:>10.3f}".format(players, name, ret['bytes'], ret['time']*1000))
+
+def runView():
+    directory = tempfile.mkdtemp()
+    bigMap = os.path.join(directory, 'bench.json')
+    writeJsonMap(bigMap, 150)
+    print("{:>8} {:>6} {:>12} {:>12} {:>10}".format("players", "tiles", "global bytes", "view bytes", "views ms"))
+    for mapPath, tiles in [(bf.MAP_PATH, 30), (bigMap, 150)]:
+        for players in [10, 50, 200]:
+            ret = benchView(players, mapPath = mapPath)
+            print("{:>8} {:>6} {:>12.0f} {:>12.0f} {:>10.3f}".format(players, "{}^2".format(tiles), ret['globalBytes'],
+                    ret['viewBytes'], ret['viewTime']*1000))
+    os.remove(bigMap)
+    os.rmdir(directory)
+
+def runTicks():
+    phases = ['updatePlayers', 'updateBullets', 'checkHit', 'broadcast', 'doActions']
+    print("{:>8} {:>7} {:>8} {:>10} ".format("players", "engine", "bullets", "ticks/s") +
+            " ".join("{:>20}".format(phase + " p50/p99") for phase in phases))
+    engines = [False, True] if bf.np != None else [False]
+    for players in [10, 50, 200]:
+        for vectorBullets in engines:
+            ret = benchTicks(players, vectorBullets)
+            print("{:>8} {:>7} {:>8} {:>10.1f} ".format(players, 'numpy' if vectorBullets else 'python', ret['bullets'], ret['ticksPerSec']) +
+                    " ".join("{:>20}".format("{:.3f}/{:.3f}ms".format(ret[phase]['p50']*1000, ret[phase]['p99']*1000)) for phase in phases))
+
+def runSwept():
+    print("{:>6} {:>6} {:>14} {:>8} {:>9}".format("fps", "swept", "ms per second", "hits", "tunneled"))
+    for framePerSec in [60, 30, 20]:
+        for sweptCollision in [False, True]:
+            ret = benchSwept(framePerSec, sweptCollision)
+            print("{:>6} {:>6} {:>14.1f} {:>8} {:>9}".format(framePerSec, 'on' if sweptCollision else 'off',
+                    ret['cpu']*1000, ret['hits'], ret['tunneled']))
+
+def runReplay():
+    print("{:>8} {:>12} {:>12} {:>10}".format("players", "KB per min", "record us", "speedup"))
+    for players in [10, 50]:
+        ret = benchReplay(players)
+        print("{:>8} {:>12.1f} {:>12.2f} {:>9.1f}x".format(players, ret['bytesPerMin'] / 1024, ret['recordTime']*1e6, ret['speedup']))
+
+def runAlloc():
+    print("{:>8} {:>7} {:>14} {:>10} {:>10} {:>20} {:>10}".format("players", "pool", "ms per second", "allocs/s",
+            "reused/s", "gc gen0/1/2 per s", "gc ms/s"))
+    for players in [10, 50]:
+        for pooled in [False, True]:
+            ret = benchAlloc(pooled, players)
+            print("{:>8} {:>7} {:>14.1f} {:>10.0f} {:>10.0f} {:>20} {:>10.3f}".format(players, 'on' if pooled else 'off',
+                    ret['cpu']*1000, ret['allocated'], ret['reused'],
+                    "/".join("{:.1f}".format(c) for c in ret['collections']), ret['gcTime']*1000))
+
+def runMap():
+    print("{:>6} {:>12} {:>12} {:>12} {:>10}".format("tiles", "json ms", "file ms", "coord us", "file KB"))
+    for size in [30, 300, 1000]:
+        ret = benchMap(size)
+        print("{:>6} {:>12.1f} {:>12.3f} {:>12.2f} {:>10.0f}".format("{}^2".format(size), ret['jsonTime']*1000,
+                ret['fileTime']*1000, ret['coordTime']*1e6, ret['bytes'] / 1024))
+
+def runBots():
+    print("{:>6} {:>10} {:>10} {:>8} {:>12} {:>12}".format("bots", "bots ms", "frame ms", "share", "decisions/s", "searches/s"))
+    for bots in [10, 100, 300]:
+        ret = benchBots(bots)
+        print("{:>6} {:>10.3f} {:>10.3f} {:>7.1f}% {:>12.0f} {:>12.1f}".format(bots, ret['bots']*1000, ret['frame']*1000,
+                ret['bots'] / ret['frame'] * 100, ret['decisions'], ret['searches']))
+
+def runRaycast():
+    print("{:>8} {:>14} {:>14}".format("rays", "python rays/s", "numpy rays/s"))
+    for rays in [10, 100, 1000, 10000]:
+        python = benchRaycast(rays, False)['raysPerSec']
+        numpy = benchRaycast(rays, True)['raysPerSec'] if bf.np != None else 0
+        print("{:>8} {:>14.0f} {:>14.0f}".format(rays, python, numpy))
+
+def runTransport():
+    print("{:>8} {:>10} {:>12} {:>10} {:>12}".format("writes", "pipelined", "writes/s", "tick ms", "round trips"))
+    for writes in [1, 10, 100, 1000]:
+        for pipelined in [False, True]:
+            ret = benchTransport(writes, pipelined)
+            print("{:>8} {:>10} {:>12.0f} {:>10.3f} {:>12.0f}".format(writes, 'on' if pipelined else 'off',
+                    ret['writesPerSec'], ret['tickTime']*1000, ret['roundTrips']))
+
+def runMemory():
+    ret = benchMemory()
+    print("bytes per bullet: {:.0f}".format(ret['bytesPerBullet']))
+    print("peak churn per frame: {:.0f} KB".format(ret['churnPerFrame'] / 1024))
+    print("Points created per frame: {:.0f}".format(ret['pointsPerFrame']))
+
+def runCheck():
+    engines = [False, True] if bf.np != None else [False]
+    for vectorBullets in engines:
+        checkSnapshot(vectorBullets)
+        print("snapshot: restored {} game plays the same".format('numpy' if vectorBullets else 'python'))
+        checkReplay(vectorBullets)
+        print("replay: {} game replays the same".format('numpy' if vectorBullets else 'python'))
+    checkPacked()
+    print("packed: state loads back as it was dumped")
+
+benchmarks = {
+    'bullets': runBullets,
+    'delta': runDelta,
+    'serializer': runSerializer,
+    'view': runView,
+    'ticks': runTicks,
+    'memory': runMemory,
+    'swept': runSwept,
+    'replay': runReplay,
+    'alloc': runAlloc,
+    'map': runMap,
+    'bots': runBots,
+    'raycast': runRaycast,
+    'transport': runTransport,
+    'check': runCheck,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            print("Unknown benchmark {}, choose from {}".format(name, ", ".join(benchmarks)))
+            sys.exit(1)
+    for name in names:
+        print("== {} ==".format(name))
+        benchmarks[name]()